@@ -0,0 +1,176 @@
+import logging
+import asyncio
+import math
+import os
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from metrics import Counter, Gauge, Histogram
+from quota import get_tier
+
+logger = logging.getLogger(__name__)
+
+LOAD_SHED_TOTAL = Counter("emma_load_shed_total", "Запросы, отклонённые контролем нагрузки", ["stage", "reason"])
+QUEUE_WAIT_SECONDS = Histogram("emma_admission_wait_seconds", "Ожидание слота в очереди допуска", ["stage", "tier"])
+
+# Порядок обслуживания очередей: premium первым
+TIERS = ("premium", "free")
+
+class Overloaded(Exception):
+    pass
+
+class AdmissionController:
+    # Слоты раздаются по кругу между пользователями с лимитом одновременных запросов на пользователя,
+    # чтобы один активный пользователь не занимал все слоты, пока остальные ждут.
+    # Доля reserved_share слотов доступна только premium, и очередь premium обслуживается первой.
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float, max_per_user: int, max_queue_per_user: int, reserved_share: float = 0.0):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_per_user = max_per_user
+        self.max_queue_per_user = max_queue_per_user
+        self.reserved = min(math.ceil(max_concurrent * reserved_share), max_concurrent - 1)
+        self.active = 0
+        self.tier_active = {tier: 0 for tier in TIERS}
+        self.user_active = {}
+        # tier -> user_id -> deque[future]; порядок ключей задаёт очередь round-robin
+        self.queues = {tier: OrderedDict() for tier in TIERS}
+        self.waiting = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self.waiting
+
+    def tier_depth(self, tier: str) -> int:
+        return sum(len(queue) for queue in self.queues[tier].values())
+
+    def has_capacity(self, tier: str) -> bool:
+        if self.active >= self.max_concurrent:
+            return False
+        return tier == "premium" or self.tier_active["free"] < self.max_concurrent - self.reserved
+
+    def can_run(self, user_id) -> bool:
+        return self.user_active.get(user_id, 0) < self.max_per_user
+
+    def grant(self, user_id, tier: str):
+        self.active += 1
+        self.tier_active[tier] += 1
+        self.user_active[user_id] = self.user_active.get(user_id, 0) + 1
+
+    def next_waiter(self):
+        for tier in TIERS:
+            if not self.has_capacity(tier):
+                continue
+            queues = self.queues[tier]
+            user_id = next((user_id for user_id in queues if self.can_run(user_id)), None)
+            if user_id is None:
+                continue
+            queue = queues[user_id]
+            waiter = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                queues.move_to_end(user_id)
+            else:
+                del queues[user_id]
+            return user_id, tier, waiter
+        return None
+
+    def dispatch(self):
+        while self.active < self.max_concurrent:
+            candidate = self.next_waiter()
+            if candidate is None:
+                return
+            user_id, tier, waiter = candidate
+            if not waiter.done():
+                self.grant(user_id, tier)
+                waiter.set_result(None)
+
+    def remove_waiter(self, user_id, tier: str, waiter):
+        queue = self.queues[tier].get(user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[tier][user_id]
+
+    async def acquire(self, user_id=None, tier: str = "free") -> float:
+        if self.has_capacity(tier) and self.can_run(user_id):
+            self.grant(user_id, tier)
+            QUEUE_WAIT_SECONDS.observe(0.0, self.name, tier)
+            return 0.0
+        if self.waiting >= self.max_queue:
+            LOAD_SHED_TOTAL.inc(self.name, "queue_full")
+            logger.warning(f"Очередь {self.name} переполнена ({self.waiting}), запрос пользователя {user_id} ({tier}) отклонён")
+            raise Overloaded(self.name)
+        # Длину проверяем до setdefault: пустая очередь в queues сломает next_waiter
+        queued = len(self.queues[tier].get(user_id, ()))
+        if queued >= self.max_queue_per_user:
+            LOAD_SHED_TOTAL.inc(self.name, "user_queue_full")
+            logger.warning(f"Пользователь {user_id} уже ждёт {queued} слотов {self.name}, запрос отклонён")
+            raise Overloaded(self.name)
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.queues[tier].setdefault(user_id, deque()).append(waiter)
+        self.waiting += 1
+        enqueued_at = loop.time()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            # dispatch мог выдать слот одновременно с таймаутом — возвращаем его
+            if waiter.done() and not waiter.cancelled():
+                self.release(user_id, tier)
+            LOAD_SHED_TOTAL.inc(self.name, "timeout")
+            logger.warning(f"Истекло ожидание в очереди {self.name} для пользователя {user_id} ({tier})")
+            raise Overloaded(self.name)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(user_id, tier)
+            raise
+        finally:
+            self.remove_waiter(user_id, tier, waiter)
+        wait = loop.time() - enqueued_at
+        QUEUE_WAIT_SECONDS.observe(wait, self.name, tier)
+        return wait
+
+    def release(self, user_id=None, tier: str = "free"):
+        self.active -= 1
+        self.tier_active[tier] -= 1
+        remaining = self.user_active.get(user_id, 0) - 1
+        if remaining > 0:
+            self.user_active[user_id] = remaining
+        else:
+            self.user_active.pop(user_id, None)
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id=None, tier: str = None):
+        # Уровень по умолчанию — из quota.get_tier, единственной проверки premium
+        tier = tier or get_tier(user_id)
+        wait = await self.acquire(user_id, tier)
+        try:
+            yield wait
+        finally:
+            self.release(user_id, tier)
+
+llm_admission = AdmissionController(
+    "llm",
+    max_concurrent=int(os.getenv("LLM_MAX_CONCURRENT", 8)),
+    max_queue=int(os.getenv("LLM_MAX_QUEUE", 32)),
+    queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", 10)),
+    max_per_user=int(os.getenv("LLM_MAX_CONCURRENT_PER_USER", 2)),
+    max_queue_per_user=int(os.getenv("LLM_MAX_QUEUE_PER_USER", 4)),
+    reserved_share=float(os.getenv("LLM_PREMIUM_RESERVED_SHARE", 0.25)),
+)
+search_admission = AdmissionController(
+    "search",
+    max_concurrent=int(os.getenv("SEARCH_MAX_CONCURRENT", 16)),
+    max_queue=int(os.getenv("SEARCH_MAX_QUEUE", 64)),
+    queue_timeout=float(os.getenv("SEARCH_QUEUE_TIMEOUT", 3)),
+    max_per_user=int(os.getenv("SEARCH_MAX_CONCURRENT_PER_USER", 2)),
+    max_queue_per_user=int(os.getenv("SEARCH_MAX_QUEUE_PER_USER", 4)),
+    reserved_share=float(os.getenv("SEARCH_PREMIUM_RESERVED_SHARE", 0.25)),
+)
+
+LLM_QUEUE_DEPTH = Gauge("emma_llm_queue_depth", "Запросы, ожидающие слота LLM", callback=lambda: llm_admission.queue_depth)
+SEARCH_QUEUE_DEPTH = Gauge("emma_search_queue_depth", "Запросы, ожидающие слота поиска", callback=lambda: search_admission.queue_depth)
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Все модули верхнего уровня репозитория, чтобы новые модули сразу попадали в отчёт
+PROJECT_MODULES = sorted(name[:-3] for name in os.listdir(ROOT) if name.endswith(".py"))
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| *(\S+)$")
+
+def bench_env() -> dict:
+    env = dict(os.environ)
+    env.setdefault("TELEGRAM_TOKEN", "123456:BENCHMARK-TOKEN")
+    env.pop("FIREBASE_CREDENTIALS_JSON", None)
+    env.pop("FIREBASE_CREDENTIALS_PATH", None)
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+def measure_imports(module: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=bench_env(), cwd=ROOT,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} завершился с ошибкой:\n{result.stderr[-2000:]}")
+    project = {}
+    top_level = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        name = match.group(3)
+        if name in PROJECT_MODULES:
+            project[name] = cumulative_ms
+        elif "." not in name:
+            top_level[name] = max(top_level.get(name, 0), cumulative_ms)
+    heaviest = dict(sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:10])
+    return {"total_ms": project.get(module, 0), "project_ms": project, "packages_ms": heaviest}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def measure_first_health(timeout: float) -> float:
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        env=bench_env(), cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn завершился с кодом {process.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    if response.status == 200:
+                        return (time.perf_counter() - started) * 1000
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError(f"/health не ответил за {timeout} с")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def summarize(samples: list) -> dict:
+    return {
+        "min": round(min(samples), 1),
+        "median": round(statistics.median(samples), 1),
+        "max": round(max(samples), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк холодного старта: время импорта и время до первого /health")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--modules", nargs="*", default=["main", "handlers", "utils", "database"])
+    parser.add_argument("--skip-health", action="store_true")
+    parser.add_argument("--json", dest="json_path")
+    args = parser.parse_args()
+
+    report = {"python": sys.version.split()[0], "runs": args.runs, "imports": {}, "first_health_ms": None}
+    for module in args.modules:
+        runs = [measure_imports(module) for _ in range(args.runs)]
+        report["imports"][module] = {
+            "total_ms": summarize([run["total_ms"] for run in runs]),
+            "project_ms": {name: round(statistics.median(run["project_ms"].get(name, 0) for run in runs), 1) for name in runs[0]["project_ms"]},
+            "packages_ms": {name: round(value, 1) for name, value in runs[-1]["packages_ms"].items()},
+        }
+        print(f"import {module}: медиана {report['imports'][module]['total_ms']['median']} мс")
+        for name, value in report["imports"][module]["packages_ms"].items():
+            print(f"    {name:<24} {value:>8.1f} мс")
+    if not args.skip_health:
+        samples = [measure_first_health(args.timeout) for _ in range(args.runs)]
+        report["first_health_ms"] = summarize(samples)
+        print(f"Время до первого /health: медиана {report['first_health_ms']['median']} мс (min {report['first_health_ms']['min']}, max {report['first_health_ms']['max']})")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
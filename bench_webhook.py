@@ -0,0 +1,410 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import urllib.request
+import aiohttp
+from bench_startup import ROOT, bench_env, free_port
+
+RESULTS_DIR = os.path.join(ROOT, "bench_results")
+METRIC_LINE = re.compile(r"^([a-zA-Z_:][\w:]*)(\{[^}]*\})?\s+(\S+)$")
+DEFAULT_MIX = "text=70,callback=12,start=5,pay=5,payment=3,info=5"
+SAMPLE_TEXTS = [
+    "Привет! Как дела?",
+    "Расскажи про тёмную материю и тёмную энергию",
+    "Что посоветуешь почитать про мотивацию?",
+    "Мне сегодня грустно",
+    "Напиши функцию на python для сортировки списка",
+    "Какие новые альбомы вышли в этом году?",
+    "Как перестать прокрастинировать?",
+    "Объясни простыми словами, что такое нейросеть",
+    "Спасибо, ты лучшая!",
+    "Расскажи подробнее",
+]
+SAMPLE_CALLBACKS = ["show_plans", "plan_1month", "back_to_plans", "Расскажи ещё", "Что ещё посоветуешь?"]
+PAYLOADS = ["emma_premium_1month", "emma_premium_3months", "emma_premium_12months"]
+
+class UpdateFactory:
+    def __init__(self, users: int, mix: dict, seed: int, first_user_id: int = 10_000_000):
+        self.random = random.Random(seed)
+        self.user_ids = [first_user_id + i for i in range(users)]
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.started = set()
+        # Новый диапазон update_id на каждый запуск, чтобы не упереться в processed_updates
+        self.update_ids = iter(range(int(time.time() * 1000), 2 ** 62))
+        self.message_ids = iter(range(1, 2 ** 62))
+
+    def user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+    def message(self, user_id: int, **fields) -> dict:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id),
+        }
+        message.update(fields)
+        return message
+
+    def text(self, user_id: int, text: str) -> dict:
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else None
+        fields = {"text": text}
+        if entities:
+            fields["entities"] = entities
+        return {"update_id": next(self.update_ids), "message": self.message(user_id, **fields)}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.message_ids)),
+                "from": self.user(user_id),
+                "chat_instance": str(user_id),
+                "message": self.message(user_id, text="Выбери вариант"),
+                "data": data,
+            },
+        }
+
+    def payment(self, user_id: int) -> list:
+        payload = self.random.choice(PAYLOADS)
+        pre_checkout = {
+            "update_id": next(self.update_ids),
+            "pre_checkout_query": {
+                "id": str(next(self.message_ids)),
+                "from": self.user(user_id),
+                "currency": "XTR",
+                "total_amount": 250,
+                "invoice_payload": payload,
+            },
+        }
+        successful = {
+            "update_id": next(self.update_ids),
+            "message": self.message(user_id, successful_payment={
+                "currency": "XTR",
+                "total_amount": 250,
+                "invoice_payload": payload,
+                "telegram_payment_charge_id": f"bench-{next(self.message_ids)}",
+                "provider_payment_charge_id": "",
+            }),
+        }
+        return [("pre_checkout", pre_checkout), ("payment", successful)]
+
+    def next(self) -> list:
+        """Очередное действие пользователя: список (вид, update), отправляемых последовательно."""
+        user_id = self.random.choice(self.user_ids)
+        if user_id not in self.started:
+            # Без /start пользователь не в состоянии waiting_for_message и текст не обрабатывается
+            self.started.add(user_id)
+            return [("start", self.text(user_id, "/start"))]
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        if kind == "text":
+            return [(kind, self.text(user_id, self.random.choice(SAMPLE_TEXTS)))]
+        if kind == "callback":
+            return [(kind, self.callback(user_id, self.random.choice(SAMPLE_CALLBACKS)))]
+        if kind == "payment":
+            return self.payment(user_id)
+        return [(kind, self.text(user_id, f"/{kind}"))]
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() and float(weight or 0) > 0:
+            mix[kind.strip()] = float(weight)
+    return mix
+
+def parse_metrics(text: str) -> dict:
+    samples = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return samples
+
+def label_value(labels: str, name: str):
+    match = re.search(rf'{name}="([^"]*)"', labels)
+    return match.group(1) if match else None
+
+def histogram_quantile(buckets: list, q: float):
+    # buckets: [(граница, накопленное число)] по возрастанию, как в Prometheus
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    lower_bound, lower_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / max(count - lower_count, 1e-9)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+def stage_timings(before: dict, after: dict) -> dict:
+    stages = {}
+    for (name, labels), value in after.items():
+        if not name.startswith("emma_stage_duration_seconds"):
+            continue
+        stage = label_value(labels, "stage")
+        delta = value - before.get((name, labels), 0)
+        entry = stages.setdefault(stage, {"count": 0, "sum": 0.0, "buckets": []})
+        if name.endswith("_count"):
+            entry["count"] = delta
+        elif name.endswith("_sum"):
+            entry["sum"] = delta
+        elif name.endswith("_bucket"):
+            entry["buckets"].append((float(label_value(labels, "le")), delta))
+    report = {}
+    for stage, entry in sorted(stages.items()):
+        if entry["count"] <= 0:
+            continue
+        buckets = sorted(entry["buckets"])
+        report[stage] = {
+            "count": int(entry["count"]),
+            "mean_ms": round(entry["sum"] / entry["count"] * 1000, 1),
+            "p95_ms": round((histogram_quantile(buckets, 0.95) or 0) * 1000, 1),
+        }
+    return report
+
+def gauge(samples: dict, name: str) -> float:
+    return samples.get((name, ""), 0)
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(int(len(ordered) * q), len(ordered) - 1)] * 1000, 1)
+    return {"count": len(ordered), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 1)}
+
+def read_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+def git_revision() -> dict:
+    def run(*args):
+        result = subprocess.run(["git", *args], capture_output=True, text=True, cwd=ROOT)
+        return result.stdout.strip() if result.returncode == 0 else ""
+    return {"commit": run("rev-parse", "--short", "HEAD") or "unknown", "dirty": bool(run("status", "--porcelain", "--untracked-files=no"))}
+
+def wait_for(url: str, timeout: float, process=None):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args[1:3])} завершился с кодом {process.returncode}")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"{url} не ответил за {timeout} с")
+
+def add_stack_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-quotas", action="store_true", help="не поднимать лимиты бесплатного тарифа")
+    parser.add_argument("--llm-latency", type=float)
+    parser.add_argument("--llm-error-rate", type=float)
+    parser.add_argument("--llm-429-rate", type=float)
+    parser.add_argument("--cse-latency", type=float)
+    parser.add_argument("--telegram-latency", type=float)
+    parser.add_argument("--app-log", help="куда писать вывод uvicorn")
+
+def start_stack(args) -> tuple:
+    stub_port, app_port = free_port(), free_port()
+    stub_args = [sys.executable, os.path.join(ROOT, "stub_servers.py"), "--port", str(stub_port), "--seed", str(args.seed)]
+    for option in ("llm_latency", "llm_error_rate", "llm_429_rate", "cse_latency", "telegram_latency"):
+        value = getattr(args, option)
+        if value is not None:
+            stub_args += [f"--{option.replace('_', '-')}", str(value)]
+    stubs = subprocess.Popen(stub_args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for(f"http://127.0.0.1:{stub_port}/stub/stats", 30, stubs)
+    env = bench_env()
+    env.update({
+        "OPENROUTER_BASE_URL": f"http://127.0.0.1:{stub_port}/openai/api/v1",
+        "OPENROUTER_API_KEY": "bench",
+        "GOOGLE_CSE_URL": f"http://127.0.0.1:{stub_port}/cse/customsearch/v1",
+        "GOOGLE_API_KEY": "bench",
+        "GOOGLE_CSE_ID": "bench",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{stub_port}/telegram",
+        "RENDER_URL": f"127.0.0.1:{app_port}",
+    })
+    if not args.keep_quotas:
+        # Тысячи синтетических пользователей иначе упрутся в лимиты бесплатного тарифа
+        for name, value in (("FREE_DAILY_LIMIT", "1000000"), ("FREE_RATE_PER_MINUTE", "100000"), ("FREE_BURST", "1000")):
+            env.setdefault(name, value)
+    log = open(args.app_log, "w") if args.app_log else subprocess.DEVNULL
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"],
+        env=env, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT,
+    )
+    wait_for(f"http://127.0.0.1:{app_port}/ready", 60, app)
+    return f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{stub_port}", [app, stubs]
+
+def stop_stack(processes: list):
+    for process in processes:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+async def fetch_text(session: aiohttp.ClientSession, url: str) -> str:
+    async with session.get(url) as response:
+        return await response.text()
+
+async def run_load(base_url: str, factory: UpdateFactory, rate: float, duration: float, max_connections: int) -> dict:
+    latencies = {}
+    outcomes = {}
+    connector = aiohttp.TCPConnector(limit=max_connections)
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def send(actions: list, scheduled_at: float):
+            # Задержка считается от запланированного момента, чтобы не скрывать очередь (coordinated omission)
+            for kind, update in actions:
+                try:
+                    async with session.post(f"{base_url}/webhook", json=update) as response:
+                        body = await response.json(content_type=None)
+                        ok = response.status == 200 and body.get("status") == "ok"
+                        outcome = "ok" if ok else f"http_{response.status}" if response.status != 200 else "error"
+                except Exception as e:
+                    outcome = type(e).__name__
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                latencies.setdefault(kind, []).append(time.perf_counter() - scheduled_at)
+                scheduled_at = time.perf_counter()
+
+        tasks = []
+        started = time.perf_counter()
+        total = int(rate * duration)
+        for i in range(total):
+            scheduled_at = started + i / rate
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(factory.next(), scheduled_at)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "sent_updates": len(all_latencies),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(all_latencies) / elapsed, 1) if elapsed else 0,
+        "outcomes": outcomes,
+        "latency": percentiles(all_latencies),
+        "latency_by_kind": {kind: percentiles(values) for kind, values in sorted(latencies.items())},
+    }
+
+def find_result(reference: str) -> str:
+    if os.path.exists(reference):
+        return reference
+    matches = sorted(glob.glob(os.path.join(RESULTS_DIR, f"{reference}*.json")))
+    if not matches:
+        raise RuntimeError(f"Нет сохранённых результатов для {reference} в {RESULTS_DIR}")
+    return matches[-1]
+
+def print_comparison(current: dict, baseline: dict):
+    def change(new, old):
+        if not old:
+            return "—"
+        return f"{(new - old) / old * 100:+.1f}%"
+    print(f"\nСравнение с {baseline['revision']['commit']} ({baseline['started_at']}):")
+    rows = [("throughput_rps", current["load"]["throughput_rps"], baseline["load"]["throughput_rps"])]
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        rows.append((key, current["load"]["latency"].get(key, 0), baseline["load"]["latency"].get(key, 0)))
+    for stage, entry in current["stages"].items():
+        old = baseline["stages"].get(stage, {}).get("p95_ms")
+        if old is not None:
+            rows.append((f"{stage} p95_ms", entry["p95_ms"], old))
+    for name, new, old in rows:
+        print(f"    {name:<36} {old:>10} -> {new:>10}  {change(new, old)}")
+
+def print_report(report: dict):
+    load = report["load"]
+    print(f"Отправлено {load['sent_updates']} обновлений за {load['elapsed_s']} с: {load['throughput_rps']} обн/с, исходы {load['outcomes']}")
+    latency = load["latency"]
+    print(f"Задержка: p50 {latency.get('p50_ms')} мс, p95 {latency.get('p95_ms')} мс, p99 {latency.get('p99_ms')} мс")
+    for kind, entry in load["latency_by_kind"].items():
+        print(f"    {kind:<14} n={entry['count']:<6} p50 {entry['p50_ms']:>8} мс  p95 {entry['p95_ms']:>8} мс  p99 {entry['p99_ms']:>8} мс")
+    memory = report["memory"]
+    print(f"user_data: {memory['users_before']} -> {memory['users_after']}, processed_updates: {memory['processed_before']} -> {memory['processed_after']}, RSS: {memory['rss_before_mb']} -> {memory['rss_after_mb']} МБ")
+    print("Этапы:")
+    for stage, entry in report["stages"].items():
+        print(f"    {stage:<28} n={entry['count']:<6} среднее {entry['mean_ms']:>8} мс  p95 {entry['p95_ms']:>8} мс")
+
+async def benchmark(args) -> dict:
+    processes = []
+    stub_url = None
+    base_url = args.url
+    if base_url is None:
+        base_url, stub_url, processes = start_stack(args)
+    try:
+        factory = UpdateFactory(args.users, parse_mix(args.mix), args.seed)
+        async with aiohttp.ClientSession() as session:
+            before = parse_metrics(await fetch_text(session, f"{base_url}/metrics"))
+            rss_before = read_rss_mb(processes[0].pid) if processes else None
+            load = await run_load(base_url, factory, args.rate, args.duration, args.max_connections)
+            after = parse_metrics(await fetch_text(session, f"{base_url}/metrics"))
+            rss_after = read_rss_mb(processes[0].pid) if processes else None
+            upstream = json.loads(await fetch_text(session, f"{stub_url}/stub/stats")) if stub_url else None
+    finally:
+        stop_stack(processes)
+    return {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "config": {key: value for key, value in vars(args).items() if key not in ("json_path", "compare")},
+        "load": load,
+        "memory": {
+            "users_before": int(gauge(before, "emma_users_in_memory")),
+            "users_after": int(gauge(after, "emma_users_in_memory")),
+            "processed_before": int(gauge(before, "emma_processed_updates")),
+            "processed_after": int(gauge(after, "emma_processed_updates")),
+            "rss_before_mb": rss_before,
+            "rss_after_mb": rss_after,
+        },
+        "stages": stage_timings(before, after),
+        "upstream": upstream,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /webhook синтетическими обновлениями Telegram")
+    parser.add_argument("--url", help="уже запущенный экземпляр; по умолчанию поднимаются заглушки и uvicorn")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=50, help="действий пользователей в секунду")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса видов обновлений")
+    parser.add_argument("--max-connections", type=int, default=500)
+    add_stack_arguments(parser)
+    parser.add_argument("--json", dest="json_path", help="путь для результата; по умолчанию bench_results/<commit>-<время>.json")
+    parser.add_argument("--compare", help="коммит или файл результата для сравнения")
+    args = parser.parse_args()
+
+    report = asyncio.run(benchmark(args))
+    print_report(report)
+    json_path = args.json_path
+    if json_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        revision = report["revision"]
+        suffix = "-dirty" if revision["dirty"] else ""
+        json_path = os.path.join(RESULTS_DIR, f"{revision['commit']}{suffix}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результат сохранён: {json_path}")
+    if args.compare:
+        with open(find_result(args.compare), encoding="utf-8") as f:
+            print_comparison(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,27 @@
 import logging
-import firebase_admin
-from firebase_admin import credentials, firestore
+import asyncio
 import os
 import base64
+import copy
 import json
-from state import user_data
+import hashlib
+from state import user_data, file_id_cache
+from metrics import timed, STAGE_SECONDS, Counter, Gauge
+from resilience import RetryPolicy, CircuitOpen, firestore_retry, firestore_breaker
 
 logger = logging.getLogger(__name__)
 
+ARCHIVE_DROPPED = Counter("emma_archive_dropped_total", "Сообщения, не попавшие в архив Firestore", ["reason"])
+
+storage_ready = asyncio.Event()
+
+def get_db():
+    from firebase_admin import firestore
+    return firestore.client()
+
 def init_firebase():
+    import firebase_admin
+    from firebase_admin import credentials
     firebase_credentials = os.getenv("FIREBASE_CREDENTIALS_JSON")
     if firebase_credentials:
         try:
@@ -26,37 +39,185 @@ def init_firebase():
             logger.info("Firebase инициализирован успешно (локальный путь)")
         else:
             logger.warning("Firebase не инициализирован (проверь FIREBASE_CREDENTIALS_PATH или FIREBASE_CREDENTIALS_JSON)")
+
+def load_user_data():
     try:
-        db = firestore.client()
+        db = get_db()
         docs = db.collection("users").stream()
+        loaded = 0
         for doc in docs:
             try:
                 user_id_int = int(doc.id)
-                user_data[user_id_int] = doc.to_dict()
-                logger.info(f"Загружены данные пользователя {user_id_int} из Firestore")
+                user_data.setdefault(user_id_int, doc.to_dict())
+                loaded += 1
             except ValueError:
                 logger.warning(f"Пропуск невалидного user_id: {doc.id} (не число)")
-        logger.info("Все user_data загружены из Firestore")
+        logger.info(f"Все user_data загружены из Firestore: {loaded} пользователей")
     except Exception as e:
         logger.error(f"Ошибка загрузки user_data из Firestore: {e}")
 
+async def load_storage():
+    try:
+        await asyncio.to_thread(init_firebase)
+        await asyncio.to_thread(load_user_data)
+        await asyncio.to_thread(load_file_ids)
+    finally:
+        storage_ready.set()
+
+@timed("firestore_save_user")
 async def save_user_data(user_id: int, data: dict):
     try:
-        db = firestore.client()
-        db.collection("users").document(str(user_id)).set(data, merge=True)
+        db = get_db()
+        # Снимок на event loop: поток сериализует его, пока обработчики продолжают менять user_data
+        snapshot = copy.deepcopy(data)
+        await firestore_retry.call(asyncio.to_thread, db.collection("users").document(str(user_id)).set, snapshot, merge=True)
         logger.info(f"Сохранены user_data для {user_id} в Firestore")
     except Exception as e:
         logger.error(f"Ошибка сохранения user_data: {e}")
 
-async def save_message_to_firestore(user_id: str, text: str, message_id: str):
+def load_file_ids():
     try:
-        db = firestore.client()
-        doc_ref = db.collection("messages").document(message_id)
-        doc_ref.set({
-            "user_id": user_id,
-            "text": text,
-            "timestamp": firestore.SERVER_TIMESTAMP,
+        db = get_db()
+        for doc in db.collection("media_cache").stream():
+            data = doc.to_dict()
+            if data.get("path") and data.get("file_id"):
+                file_id_cache[data["path"]] = {
+                    "file_id": data["file_id"],
+                    "signature": data.get("signature"),
+                }
+        logger.info(f"Загружено {len(file_id_cache)} file_id из Firestore")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки file_id из Firestore: {e}")
+
+@timed("firestore_save_file_id")
+async def save_file_id(path: str, file_id: str, signature: str):
+    try:
+        db = get_db()
+        doc_id = hashlib.sha1(path.encode()).hexdigest()
+        await firestore_retry.call(asyncio.to_thread, db.collection("media_cache").document(doc_id).set, {
+            "path": path,
+            "file_id": file_id,
+            "signature": signature,
         })
-        logger.info(f"Сообщение сохранено в Firestore с ID: {message_id}")
+        logger.info(f"Сохранён file_id для {path} в Firestore")
+    except Exception as e:
+        logger.error(f"Ошибка сохранения file_id: {e}")
+
+class MessageOutbox:
+    def __init__(self, batch_size: int, flush_interval: float, max_retries: int, max_pending: int, max_outage: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.max_pending = max_pending
+        self.max_outage = max_outage
+        self.retry = RetryPolicy("firestore_archive", max_attempts=max_retries + 1, base_delay=1.0, max_delay=30.0, breaker=firestore_breaker)
+        self.queue = asyncio.Queue()
+        self.in_progress = 0
+        self.task = None
+
+    @property
+    def pending(self) -> int:
+        return self.queue.qsize() + self.in_progress
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+            logger.info("Outbox архива сообщений запущен")
+
+    def enqueue(self, user_id: str, text: str, message_id: str):
+        if self.pending >= self.max_pending:
+            # Долгий простой Firestore не должен раздувать память: новые сообщения не архивируем
+            ARCHIVE_DROPPED.inc("buffer_full")
+            logger.warning(f"Буфер архива переполнен ({self.pending}), сообщение {message_id} не будет сохранено")
+            return
+        self.queue.put_nowait({"user_id": user_id, "text": text, "message_id": message_id})
+
+    async def drain(self, timeout: float) -> list:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.pending and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        abandoned = []
+        while not self.queue.empty():
+            abandoned.append(self.queue.get_nowait()["message_id"])
+        if self.in_progress:
+            abandoned.append(f"<{self.in_progress} в незавершённом пакете>")
+            self.in_progress = 0
+        return abandoned
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            self.in_progress = 1
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    self.in_progress = len(batch)
+                except asyncio.TimeoutError:
+                    break
+            await self._commit_with_retry(batch)
+            self.in_progress = 0
+
+    async def _commit_with_retry(self, batch: list) -> bool:
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + self.max_outage
+        while True:
+            try:
+                with STAGE_SECONDS.time("firestore_archive"):
+                    await self.retry.call(asyncio.to_thread, self._commit, batch)
+                logger.info(f"Сохранено {len(batch)} сообщений в Firestore")
+                return True
+            except CircuitOpen:
+                if loop.time() >= give_up_at:
+                    ARCHIVE_DROPPED.inc("outage", amount=len(batch))
+                    logger.error(f"Firestore недоступен дольше {self.max_outage} с, пакет из {len(batch)} сообщений отброшен")
+                    return False
+                # Firestore недоступен — ждём пробного окна breaker, но не дольше max_outage
+                await asyncio.sleep(min(max(firestore_breaker.retry_in(), 1.0), max(give_up_at - loop.time(), 0)))
+            except Exception as e:
+                ARCHIVE_DROPPED.inc("error", amount=len(batch))
+                logger.error(f"Не удалось сохранить {len(batch)} сообщений в Firestore: {e}")
+                return False
+
+    def _commit(self, batch: list):
+        from firebase_admin import firestore
+        db = get_db()
+        write_batch = db.batch()
+        for item in batch:
+            write_batch.set(db.collection("messages").document(item["message_id"]), {
+                "user_id": item["user_id"],
+                "text": item["text"],
+                "timestamp": firestore.SERVER_TIMESTAMP,
+            })
+        write_batch.commit()
+
+@timed("firestore_read_message")
+async def get_archived_message(message_id: str):
+    try:
+        db = get_db()
+        doc = await firestore_retry.call(asyncio.to_thread, db.collection("messages").document(message_id).get)
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        return {"message_id": message_id, "user_id": str(data.get("user_id")), "text": data.get("text", "")}
     except Exception as e:
-        logger.error(f"Ошибка сохранения в Firestore: {e}")
\ No newline at end of file
+        logger.error(f"Ошибка чтения сообщения {message_id} из Firestore: {e}")
+        return None
+
+message_outbox = MessageOutbox(
+    batch_size=int(os.getenv("ARCHIVE_BATCH_SIZE", 100)),
+    flush_interval=float(os.getenv("ARCHIVE_FLUSH_INTERVAL", 1.0)),
+    max_retries=int(os.getenv("ARCHIVE_MAX_RETRIES", 5)),
+    max_pending=int(os.getenv("ARCHIVE_MAX_PENDING", 5000)),
+    max_outage=float(os.getenv("ARCHIVE_MAX_OUTAGE", 300)),
+)
+ARCHIVE_PENDING = Gauge("emma_archive_pending", "Сообщения, ожидающие сохранения в Firestore", callback=lambda: message_outbox.pending)
\ No newline at end of file
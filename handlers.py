@@ -1,16 +1,22 @@
 import logging
 import asyncio
 import re
+import time
 from aiogram import Router, types, F, Bot
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, BotCommand, WebAppInfo
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BotCommand, WebAppInfo, LabeledPrice
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.utils.chat_action import ChatActionSender
 from datetime import datetime, timedelta
 import os
-from utils import validate_and_fix_html, get_unlim_response, get_google_cse_info, extract_topic, is_relevant, send_long_message
+from utils import validate_and_fix_html, get_unlim_response, get_google_cse_info, extract_topic, is_relevant, send_long_message, send_cached_photo
 from database import save_user_data
-from state import user_data, UserState
+from state import user_data, invoice_links, UserState
+from metrics import timed, Histogram
+from usage import usage_aggregator, today
+from quota import check_quota, get_quota_reply, get_tier
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +27,64 @@ MINIAPP_URL = os.getenv("MINIAPP_URL")
 MINIAPP_BUTTON_TEXT = os.getenv("MINIAPP_BUTTON_TEXT", "🎀Просмотр🎀")
 PAY_IMAGE_PATH = os.getenv("PAY_IMAGE_PATH", "./images/pay_image.jpg")
 START_IMAGE_PATH = os.getenv("START_IMAGE_PATH", "./images/start_image.jpg")
+TYPING_ACTION_INTERVAL = float(os.getenv("TYPING_ACTION_INTERVAL", 4.0))
+
+# Время от получения сообщения до отправки ответа — для контроля SLA premium
+RESPONSE_SECONDS = Histogram("emma_response_seconds", "Время ответа пользователю по тарифу", ["tier"])
+
+PLANS_TEXT = (
+    "<b>Я предлагаю несколько тарифных планов, чтобы ты мог выбрать тот, который подходит именно тебе!</b> 😊\n\n"
+    "По каждому тарифу ты получишь <b>50 запросов в сутки</b> для общения со мной! 💬\n\n"
+    "⦁ <b>1 месяц — 250⭐️ (~429₽)</b>\n"
+    "  Этот тариф — отличный способ начать. Ты получаешь всё необходимое для продуктивного старта. Это самый популярный вариант — Хит!\n\n"
+    "⦁ <b>3 месяца — 600⭐️ (~1008₽)</b>\n"
+    "  Выгодный тариф, который позволит тебе экономить и получать ещё больше пользы. Всего 336₽ в месяц при полном доступе к моим возможностям.\n\n"
+    "⦁ <b>12 месяцев — 2000⭐️ (~3298₽)</b>\n"
+    "  Для тех, кто действительно хочет погрузиться в процесс и получить максимальный эффект. Ты получаешь полный доступ по лучшей цене — всего 274₽ в месяц.\n\n"
+    "<i>Выбери свой план, и я буду рядом, помогая идти к мечтам шаг за шагом!</i> ✨"
+)
+
+PLANS = {
+    "plan_1month": {
+        "name": "1 месяца",
+        "title": "Подписка на Эмму — 1 месяц",
+        "description": (
+            "1 месяц — 250⭐️ (~429₽)\n"
+            "Это идеальный старт для тех, кто хочет почувствовать мою поддержку и мотивацию. "
+            "Я буду с тобой каждый день, помогая делать первые шаги к твоим целям и поддерживая вдохновение! 😊✨"
+        ),
+        "button_text": "Подписаться на 1 месяц",
+        "payload": "emma_premium_1month",
+        "label": "Месячная подписка",
+        "amount": 250,
+    },
+    "plan_3months": {
+        "name": "3 месяцев",
+        "title": "Подписка на Эмму — 3 месяца",
+        "description": (
+            "3 месяца — 600⭐️ (~1008₽)\n"
+            "Отличный выбор для тех, кто хочет стабильной и длительной поддержки. "
+            "Я помогу не сбиться с курса, поддержу в трудные моменты и подскажу пути для достижения новых высот! 😊✨"
+        ),
+        "button_text": "Подписаться на 3 месяца",
+        "payload": "emma_premium_3months",
+        "label": "Подписка на 3 месяца",
+        "amount": 600,
+    },
+    "plan_12months": {
+        "name": "12 месяцев",
+        "title": "Подписка на Эмму — 12 месяцев",
+        "description": (
+            "12 месяцев — 2000⭐️ (~3298₽)\n"
+            "Этот тариф для тех, кто готов ко всесторонней работе и планирует двигаться к мечтам длительное время. "
+            "Год моей поддержки и мотивации — вместе мы достигнем всего, что задумано! 😊✨"
+        ),
+        "button_text": "Подписаться на 12 месяцев",
+        "payload": "emma_premium_12months",
+        "label": "Подписка на 12 месяцев",
+        "amount": 2000,
+    },
+}
 
 async def set_bot_commands(bot: Bot):
     commands = [
@@ -38,16 +102,19 @@ async def set_bot_commands(bot: Bot):
 async def start_command(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     logger.info(f"Команда /start от пользователя {user_id}")
+    previous = user_data.get(user_id, {})
     user_data[user_id] = {
         "history": [],
         "active_topic": None,
-        "premium": False,
-        "expiry": None,
+        "premium": previous.get("premium", False),
+        "expiry": previous.get("expiry", None),
         "last_pay_message_id": None,
         "awaiting_feedback": False,
         "feedback_message_id": None,
         "user_feedback_message_id": None,
     }
+    if "quota" in previous:
+        user_data[user_id]["quota"] = previous["quota"]
     await state.set_state(UserState.waiting_for_message)
     start_text = (
         "<b>Привет! Меня зовут Эмма — я твой личный виртуальный компаньон и помощник. 🌟</b>\n\n"
@@ -58,30 +125,18 @@ async def start_command(message: types.Message, state: FSMContext):
         "<i>Давай начнём! Просто отправь мне сообщение — и пусть наше общение станет твоим новым приятным опытом.</i> ✨"
     )
     sent_message = None
-    if START_IMAGE_PATH.startswith("http"):
-        try:
-            sent_message = await message.bot.send_photo(
-                chat_id=message.chat.id,
-                photo=START_IMAGE_PATH,
-                caption=start_text,
-                parse_mode="HTML",
-            )
+    try:
+        sent_message = await send_cached_photo(
+            message.bot,
+            message.chat.id,
+            START_IMAGE_PATH,
+            caption=start_text,
+            parse_mode="HTML",
+        )
+        if sent_message:
             logger.info(f"Отправлено сообщение с фото для /start, message_id: {sent_message.message_id}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки фото для /start: {e}")
-    else:
-        if os.path.exists(START_IMAGE_PATH):
-            try:
-                photo = FSInputFile(START_IMAGE_PATH)
-                sent_message = await message.bot.send_photo(
-                    chat_id=message.chat.id,
-                    photo=photo,
-                    caption=start_text,
-                    parse_mode="HTML",
-                )
-                logger.info(f"Отправлено сообщение с фото для /start, message_id: {sent_message.message_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки фото для /start: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка отправки фото для /start: {e}")
     if sent_message is None:
         sent_message = await message.answer(start_text, parse_mode="HTML")
         logger.info(f"Отправлено текстовое сообщение для /start, message_id: {sent_message.message_id}")
@@ -128,16 +183,19 @@ async def info_command(message: types.Message):
 async def clear_command(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     logger.info(f"Команда /clear от пользователя {user_id}")
+    previous = user_data.get(user_id, {})
     user_data[user_id] = {
         "history": [],
         "active_topic": None,
-        "premium": user_data.get(user_id, {}).get("premium", False),
-        "expiry": user_data.get(user_id, {}).get("expiry", None),
+        "premium": previous.get("premium", False),
+        "expiry": previous.get("expiry", None),
         "last_pay_message_id": None,
         "awaiting_feedback": False,
         "feedback_message_id": None,
         "user_feedback_message_id": None,
     }
+    if "quota" in previous:
+        user_data[user_id]["quota"] = previous["quota"]
     await state.set_state(UserState.waiting_for_message)
     await message.answer("История очищена! 😊 Начинаем с чистого листа.", parse_mode="HTML")
     await save_user_data(user_id, user_data[user_id])
@@ -168,32 +226,19 @@ async def pay_command(message: types.Message):
         [InlineKeyboardButton(text="🎀Продлить доступ🎀", callback_data="show_plans")]
     ])
     sent_message = None
-    if PAY_IMAGE_PATH.startswith("http"):
-        try:
-            sent_message = await message.bot.send_photo(
-                chat_id=message.chat.id,
-                photo=PAY_IMAGE_PATH,
-                caption=pay_text,
-                parse_mode="HTML",
-                reply_markup=reply_markup,
-            )
+    try:
+        sent_message = await send_cached_photo(
+            message.bot,
+            message.chat.id,
+            PAY_IMAGE_PATH,
+            caption=pay_text,
+            parse_mode="HTML",
+            reply_markup=reply_markup,
+        )
+        if sent_message:
             logger.info(f"Отправлено сообщение с фото для /pay, message_id: {sent_message.message_id}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки фото для /pay: {e}")
-    else:
-        if os.path.exists(PAY_IMAGE_PATH):
-            try:
-                photo = FSInputFile(PAY_IMAGE_PATH)
-                sent_message = await message.bot.send_photo(
-                    chat_id=message.chat.id,
-                    photo=photo,
-                    caption=pay_text,
-                    parse_mode="HTML",
-                    reply_markup=reply_markup,
-                )
-                logger.info(f"Отправлено сообщение с фото для /pay, message_id: {sent_message.message_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки фото для /pay: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка отправки фото для /pay: {e}")
     if sent_message is None:
         sent_message = await message.answer(pay_text, reply_markup=reply_markup, parse_mode="HTML")
         logger.info(f"Отправлено текстовое сообщение для /pay, message_id: {sent_message.message_id}")
@@ -316,6 +361,92 @@ async def reply_command(message: types.Message):
             parse_mode="HTML",
         )
 
+def format_usage_line(entry: dict) -> str:
+    average_latency = entry["latency_ms"] // entry["requests"] if entry["requests"] else 0
+    average_wait = entry["queue_wait_ms"] // entry["admitted"] if entry["admitted"] else 0
+    return (
+        f"{entry['requests']} запр., {entry['prompt_tokens']}+{entry['completion_tokens']} ток. "
+        f"(кэш {entry['cached_tokens']}), ср. {average_latency} мс, очередь ср. {average_wait} мс"
+    )
+
+@router.message(Command("usage"))
+async def usage_command(message: types.Message):
+    chat_id = str(message.chat.id)
+    if chat_id != FEEDBACK_CHAT_ID:
+        logger.info(f"Попытка использовать /usage вне чата обратной связи (chat_id: {chat_id})")
+        await message.answer("Эта команда доступна только в чате для обратной связи! 😊", parse_mode="HTML")
+        return
+    match = re.match(r"^/usage(?:@\w+)?(?:\s+(\d+))?(?:\s+(\d{4}-\d{2}-\d{2}))?\s*$", message.text.strip())
+    if not match:
+        await message.answer(
+            "Пожалуйста, используй формат: <b>/usage [user_id] [ГГГГ-ММ-ДД]</b>",
+            parse_mode="HTML",
+        )
+        return
+    target_user_id, day = match.group(1), match.group(2) or today()
+    if target_user_id:
+        entry = await usage_aggregator.get_user_usage(int(target_user_id), day)
+        models = "\n".join(f"⦁ {model}: {count}" for model, count in entry["models"].items()) or "—"
+        text = (
+            f"<b>Использование {target_user_id} за {day}</b>\n"
+            f"{format_usage_line(entry)}\n\n"
+            f"<b>Модели:</b>\n{models}"
+        )
+    else:
+        top = usage_aggregator.top_users(day)
+        lines = "\n".join(f"⦁ {user_id}: {format_usage_line(entry)}" for user_id, entry in top) or "Нет данных"
+        text = f"<b>Топ пользователей за {day}</b> (с момента запуска)\n{lines}"
+    await message.answer(text, parse_mode="HTML")
+
+def get_plans_markup():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎀1 Месяц🎀", callback_data="plan_1month")],
+        [InlineKeyboardButton(text="🎀3 месяца🎀", callback_data="plan_3months")],
+        [InlineKeyboardButton(text="🎀12 месяцев🎀", callback_data="plan_12months")],
+    ])
+
+async def get_invoice_link(bot: Bot, action: str) -> str:
+    if action not in invoice_links:
+        plan = PLANS[action]
+        invoice_links[action] = await bot.create_invoice_link(
+            title=plan["title"],
+            description=plan["description"],
+            payload=plan["payload"],
+            provider_token="",
+            currency="XTR",
+            prices=[LabeledPrice(label=plan["label"], amount=plan["amount"])],
+        )
+        logger.info(f"Создана ссылка на инвойс для {action}")
+    return invoice_links[action]
+
+async def edit_pay_message(callback: types.CallbackQuery, text: str, reply_markup: InlineKeyboardMarkup, parse_mode=None) -> bool:
+    message = callback.message
+    try:
+        if message.photo:
+            await message.edit_caption(caption=text, parse_mode=parse_mode, reply_markup=reply_markup)
+        elif message.text:
+            await message.edit_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+        else:
+            return False
+        return True
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return True
+        logger.warning(f"Не удалось отредактировать сообщение {message.message_id}: {e}")
+        return False
+
+async def delete_last_pay_message(callback: types.CallbackQuery, user_id: int):
+    last_pay_message_id = user_data[user_id].get("last_pay_message_id")
+    if last_pay_message_id:
+        try:
+            await callback.message.bot.delete_message(
+                chat_id=callback.message.chat.id,
+                message_id=last_pay_message_id,
+            )
+            logger.info(f"Удалено сообщение {last_pay_message_id} для пользователя {user_id}")
+        except Exception as e:
+            logger.error(f"Ошибка при удалении сообщения {last_pay_message_id}: {e}")
+
 async def handle_subscription_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     action = callback.data
@@ -330,190 +461,68 @@ async def handle_subscription_callback(callback: types.CallbackQuery):
         "feedback_message_id": None,
         "user_feedback_message_id": None,
     })
-    last_pay_message_id = user_data[user_id].get("last_pay_message_id")
-    if last_pay_message_id:
-        try:
-            await callback.message.bot.delete_message(
-                chat_id=callback.message.chat.id,
-                message_id=last_pay_message_id,
-            )
-            logger.info(f"Удалено сообщение {last_pay_message_id} для пользователя {user_id}")
-        except Exception as e:
-            logger.error(f"Ошибка при удалении сообщения {last_pay_message_id}: {e}")
-    if action == "show_plans":
-        plans_text = (
-            "<b>Я предлагаю несколько тарифных планов, чтобы ты мог выбрать тот, который подходит именно тебе!</b> 😊\n\n"
-            "По каждому тарифу ты получишь <b>50 запросов в сутки</b> для общения со мной! 💬\n\n"
-            "⦁ <b>1 месяц — 250⭐️ (~429₽)</b>\n"
-            "  Этот тариф — отличный способ начать. Ты получаешь всё необходимое для продуктивного старта. Это самый популярный вариант — Хит!\n\n"
-            "⦁ <b>3 месяца — 600⭐️ (~1008₽)</b>\n"
-            "  Выгодный тариф, который позволит тебе экономить и получать ещё больше пользы. Всего 336₽ в месяц при полном доступе к моим возможностям.\n\n"
-            "⦁ <b>12 месяцев — 2000⭐️ (~3298₽)</b>\n"
-            "  Для тех, кто действительно хочет погрузиться в процесс и получить максимальный эффект. Ты получаешь полный доступ по лучшей цене — всего 274₽ в месяц.\n\n"
-            "<i>Выбери свой план, и я буду рядом, помогая идти к мечтам шаг за шагом!</i> ✨"
-        )
-        reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎀1 Месяц🎀", callback_data="plan_1month")],
-            [InlineKeyboardButton(text="🎀3 месяца🎀", callback_data="plan_3months")],
-            [InlineKeyboardButton(text="🎀12 месяцев🎀", callback_data="plan_12months")],
-        ])
-        sent_message = None
-        if PAY_IMAGE_PATH.startswith("http"):
+    if action in ["show_plans", "back_to_plans"]:
+        reply_markup = get_plans_markup()
+        if await edit_pay_message(callback, PLANS_TEXT, reply_markup, parse_mode="HTML"):
+            user_data[user_id]["last_pay_message_id"] = callback.message.message_id
+            logger.info(f"Сообщение с тарифами обновлено на месте, message_id: {callback.message.message_id}")
+        else:
+            await delete_last_pay_message(callback, user_id)
+            sent_message = None
             try:
-                sent_message = await callback.message.bot.send_photo(
-                    chat_id=callback.message.chat.id,
-                    photo=PAY_IMAGE_PATH,
-                    caption=plans_text,
+                sent_message = await send_cached_photo(
+                    callback.message.bot,
+                    callback.message.chat.id,
+                    PAY_IMAGE_PATH,
+                    caption=PLANS_TEXT,
                     parse_mode="HTML",
                     reply_markup=reply_markup,
                 )
-                logger.info(f"Отправлено сообщение с тарифами, message_id: {sent_message.message_id}")
+                if sent_message:
+                    logger.info(f"Отправлено сообщение с тарифами, message_id: {sent_message.message_id}")
             except Exception as e:
                 logger.error(f"Ошибка отправки фото для тарифов: {e}")
-        else:
-            if os.path.exists(PAY_IMAGE_PATH):
-                try:
-                    photo = FSInputFile(PAY_IMAGE_PATH)
-                    sent_message = await callback.message.bot.send_photo(
-                        chat_id=callback.message.chat.id,
-                        photo=photo,
-                        caption=plans_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_markup,
-                    )
-                    logger.info(f"Отправлено сообщение с тарифами, message_id: {sent_message.message_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки фото для тарифов: {e}")
-        if sent_message is None:
-            sent_message = await callback.message.answer(plans_text, reply_markup=reply_markup, parse_mode="HTML")
-            logger.info(f"Отправлено текстовое сообщение с тарифами, message_id: {sent_message.message_id}")
-        user_data[user_id]["last_pay_message_id"] = sent_message.message_id
-    elif action == "plan_1month":
-        plan_text = (
-            "1 месяц — 250⭐️ (~429₽)\n"
-            "Это идеальный старт для тех, кто хочет почувствовать мою поддержку и мотивацию. "
-            "Я буду с тобой каждый день, помогая делать первые шаги к твоим целям и поддерживая вдохновение! 😊✨"
-        )
-        reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Подписаться на 1 месяц", pay=True)],
-            [InlineKeyboardButton(text="Назад", callback_data="back_to_plans")],
-        ])
-        try:
-            sent_message = await callback.message.bot.send_invoice(
-                chat_id=callback.message.chat.id,
-                title="Подписка на Эмму — 1 месяц",
-                description=plan_text,
-                payload="emma_premium_1month",
-                provider_token="",
-                currency="XTR",
-                prices=[{"label": "Месячная подписка", "amount": 250}],
-                reply_markup=reply_markup,
-            )
+            if sent_message is None:
+                sent_message = await callback.message.answer(PLANS_TEXT, reply_markup=reply_markup, parse_mode="HTML")
+                logger.info(f"Отправлено текстовое сообщение с тарифами, message_id: {sent_message.message_id}")
             user_data[user_id]["last_pay_message_id"] = sent_message.message_id
-            logger.info(f"Отправлен инвойс для 1 месяца, message_id: {sent_message.message_id}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки инвойса для 1 месяца: {e}")
-            await callback.message.answer("Что-то пошло не так при открытии оплаты. 😔 Попробуй ещё раз!", parse_mode="HTML")
-    elif action == "plan_3months":
-        plan_text = (
-            "3 месяца — 600⭐️ (~1008₽)\n"
-            "Отличный выбор для тех, кто хочет стабильной и длительной поддержки. "
-            "Я помогу не сбиться с курса, поддержу в трудные моменты и подскажу пути для достижения новых высот! 😊✨"
-        )
-        reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Подписаться на 3 месяца", pay=True)],
-            [InlineKeyboardButton(text="Назад", callback_data="back_to_plans")],
-        ])
-        try:
-            sent_message = await callback.message.bot.send_invoice(
-                chat_id=callback.message.chat.id,
-                title="Подписка на Эмму — 3 месяца",
-                description=plan_text,
-                payload="emma_premium_3months",
-                provider_token="",
-                currency="XTR",
-                prices=[{"label": "Подписка на 3 месяца", "amount": 600}],
-                reply_markup=reply_markup,
-            )
-            user_data[user_id]["last_pay_message_id"] = sent_message.message_id
-            logger.info(f"Отправлен инвойс для 3 месяцев, message_id: {sent_message.message_id}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки инвойса для 3 месяцев: {e}")
-            await callback.message.answer("Что-то пошло не так при открытии оплаты. 😔 Попробуй ещё раз!", parse_mode="HTML")
-    elif action == "plan_12months":
-        plan_text = (
-            "12 месяцев — 2000⭐️ (~3298₽)\n"
-            "Этот тариф для тех, кто готов ко всесторонней работе и планирует двигаться к мечтам длительное время. "
-            "Год моей поддержки и мотивации — вместе мы достигнем всего, что задумано! 😊✨"
-        )
-        reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Подписаться на 12 месяцев", pay=True)],
-            [InlineKeyboardButton(text="Назад", callback_data="back_to_plans")],
-        ])
+    elif action in PLANS:
+        plan = PLANS[action]
+        edited = False
         try:
-            sent_message = await callback.message.bot.send_invoice(
-                chat_id=callback.message.chat.id,
-                title="Подписка на Эмму — 12 месяцев",
-                description=plan_text,
-                payload="emma_premium_12months",
-                provider_token="",
-                currency="XTR",
-                prices=[{"label": "Подписка на 12 месяцев", "amount": 2000}],
-                reply_markup=reply_markup,
-            )
-            user_data[user_id]["last_pay_message_id"] = sent_message.message_id
-            logger.info(f"Отправлен инвойс для 12 месяцев, message_id: {sent_message.message_id}")
+            invoice_link = await get_invoice_link(callback.message.bot, action)
+            reply_markup = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=plan["button_text"], url=invoice_link)],
+                [InlineKeyboardButton(text="Назад", callback_data="back_to_plans")],
+            ])
+            edited = await edit_pay_message(callback, plan["description"], reply_markup)
         except Exception as e:
-            logger.error(f"Ошибка отправки инвойса для 12 месяцев: {e}")
-            await callback.message.answer("Что-то пошло не так при открытии оплаты. 😔 Попробуй ещё раз!", parse_mode="HTML")
-    elif action == "back_to_plans":
-        plans_text = (
-            "<b>Я предлагаю несколько тарифных планов, чтобы ты мог выбрать тот, который подходит именно тебе!</b> 😊\n\n"
-            "По каждому тарифу ты получишь <b>50 запросов в сутки</b> для общения со мной! 💬\n\n"
-            "⦁ <b>1 месяц — 250⭐️ (~429₽)</b>\n"
-            "  Этот тариф — отличный способ начать. Ты получаешь всё необходимое для продуктивного старта. Это самый популярный вариант — Хит!\n\n"
-            "⦁ <b>3 месяца — 600⭐️ (~1008₽)</b>\n"
-            "  Выгодный тариф, который позволит тебе экономить и получать ещё больше пользы. Всего 336₽ в месяц при полном доступе к моим возможностям.\n\n"
-            "⦁ <b>12 месяцев — 2000⭐️ (~3298₽)</b>\n"
-            "  Для тех, кто действительно хочет погрузиться в процесс и получить максимальный эффект. Ты получаешь полный доступ по лучшей цене — всего 274₽ в месяц.\n\n"
-            "<i>Выбери свой план, и я буду рядом, помогая идти к мечтам шаг за шагом!</i> ✨"
-        )
-        reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎀1 Месяц🎀", callback_data="plan_1month")],
-            [InlineKeyboardButton(text="🎀3 месяца🎀", callback_data="plan_3months")],
-            [InlineKeyboardButton(text="🎀12 месяцев🎀", callback_data="plan_12months")],
-        ])
-        sent_message = None
-        if PAY_IMAGE_PATH.startswith("http"):
+            logger.error(f"Ошибка создания ссылки на инвойс для {plan['name']}: {e}")
+        if edited:
+            user_data[user_id]["last_pay_message_id"] = callback.message.message_id
+            logger.info(f"Сообщение с тарифом {plan['name']} обновлено на месте, message_id: {callback.message.message_id}")
+        else:
+            await delete_last_pay_message(callback, user_id)
+            reply_markup = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=plan["button_text"], pay=True)],
+                [InlineKeyboardButton(text="Назад", callback_data="back_to_plans")],
+            ])
             try:
-                sent_message = await callback.message.bot.send_photo(
+                sent_message = await callback.message.bot.send_invoice(
                     chat_id=callback.message.chat.id,
-                    photo=PAY_IMAGE_PATH,
-                    caption=plans_text,
-                    parse_mode="HTML",
+                    title=plan["title"],
+                    description=plan["description"],
+                    payload=plan["payload"],
+                    provider_token="",
+                    currency="XTR",
+                    prices=[LabeledPrice(label=plan["label"], amount=plan["amount"])],
                     reply_markup=reply_markup,
                 )
-                logger.info(f"Отправлено сообщение с тарифами (назад), message_id: {sent_message.message_id}")
+                user_data[user_id]["last_pay_message_id"] = sent_message.message_id
+                logger.info(f"Отправлен инвойс для {plan['name']}, message_id: {sent_message.message_id}")
             except Exception as e:
-                logger.error(f"Ошибка отправки фото для тарифов (назад): {e}")
-        else:
-            if os.path.exists(PAY_IMAGE_PATH):
-                try:
-                    photo = FSInputFile(PAY_IMAGE_PATH)
-                    sent_message = await callback.message.bot.send_photo(
-                        chat_id=callback.message.chat.id,
-                        photo=photo,
-                        caption=plans_text,
-                        parse_mode="HTML",
-                        reply_markup=reply_markup,
-                    )
-                    logger.info(f"Отправлено сообщение с тарифами (назад), message_id: {sent_message.message_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки фото для тарифов (назад): {e}")
-        if sent_message is None:
-            sent_message = await callback.message.answer(plans_text, reply_markup=reply_markup, parse_mode="HTML")
-            logger.info(f"Отправлено текстовое сообщение с тарифами (назад), message_id: {sent_message.message_id}")
-        user_data[user_id]["last_pay_message_id"] = sent_message.message_id
+                logger.error(f"Ошибка отправки инвойса для {plan['name']}: {e}")
+                await callback.message.answer("Что-то пошло не так при открытии оплаты. 😔 Попробуй ещё раз!", parse_mode="HTML")
     await save_user_data(user_id, user_data[user_id])
     await callback.answer()
 
@@ -647,12 +656,12 @@ async def process_feedback(message: types.Message, state: FSMContext):
     await state.set_state(UserState.waiting_for_message)
 
 @router.message(StateFilter(UserState.waiting_for_message))
+@timed("handle_message")
 async def handle_message(message: types.Message, state: FSMContext):
+    started = time.perf_counter()
     user_id = message.from_user.id
     user_text = message.text.strip()
     logger.info(f"Получено сообщение от {user_id}: {user_text}")
-    await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
-    await asyncio.sleep(0.5)
     user_data[user_id] = user_data.get(user_id, {
         "history": [],
         "active_topic": None,
@@ -663,6 +672,11 @@ async def handle_message(message: types.Message, state: FSMContext):
         "feedback_message_id": None,
         "user_feedback_message_id": None,
     })
+    quota_exceeded = check_quota(user_id)
+    if quota_exceeded:
+        await message.answer(get_quota_reply(user_id, quota_exceeded), parse_mode="HTML")
+        await save_user_data(user_id, user_data[user_id])
+        return
     history = user_data[user_id]["history"]
     active_topic = user_data[user_id]["active_topic"]
     clarification_keywords = [
@@ -674,28 +688,29 @@ async def handle_message(message: types.Message, state: FSMContext):
         "напиши программу", "код на питоне", "код калькулятора"
     ])
     history.append({"role": "user", "content": user_text})
-    search_data = None
-    if not is_code_request:
-        is_clarification = any(keyword in user_text.lower() for keyword in clarification_keywords)
-        if is_clarification:
-            search_query = active_topic if active_topic else user_text
-            search_data = await get_google_cse_info(search_query, active_topic)
-            if search_data and not is_relevant(search_data, user_text, active_topic):
-                logger.info(f"Поиск нерелевантен для '{user_text}', fallback на контекст.")
-                search_data = None
+    async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id, interval=TYPING_ACTION_INTERVAL):
+        search_data = None
+        if not is_code_request:
+            is_clarification = any(keyword in user_text.lower() for keyword in clarification_keywords)
+            if is_clarification:
+                search_query = active_topic if active_topic else user_text
+                search_data = await get_google_cse_info(search_query, active_topic, user_id)
+                if search_data and not is_relevant(search_data, user_text, active_topic):
+                    logger.info(f"Поиск нерелевантен для '{user_text}', fallback на контекст.")
+                    search_data = None
+            else:
+                search_data = await get_google_cse_info(user_text, user_id=user_id)
+                if search_data and not is_relevant(search_data, user_text):
+                    logger.info(f"Поиск нерелевантен для '{user_text}', fallback на контекст.")
+                    search_data = None
+            if search_data:
+                logger.info(f"Агрегировано {len(search_data)} источников")
+        if isinstance(search_data, str):
+            response = search_data
         else:
-            search_data = await get_google_cse_info(user_text)
-            if search_data and not is_relevant(search_data, user_text):
-                logger.info(f"Поиск нерелевантен для '{user_text}', fallback на контекст.")
-                search_data = None
-        if search_data:
-            logger.info(f"Агрегировано {len(search_data)} источников")
-    if isinstance(search_data, str):
-        response = search_data
-        await send_long_message(message, response, parse_mode="HTML")
-    else:
-        response = await get_unlim_response(user_id, user_text, history, is_code_request, search_data)
-        await send_long_message(message, response, parse_mode="HTML")
+            response = await get_unlim_response(user_id, user_text, history, is_code_request, search_data)
+    await send_long_message(message, response, parse_mode="HTML")
+    RESPONSE_SECONDS.observe(time.perf_counter() - started, get_tier(user_id))
     history.append({"role": "assistant", "content": response})
     user_data[user_id]["history"] = history[-20:]
     user_data[user_id]["active_topic"] = extract_topic(response)
@@ -704,12 +719,12 @@ async def handle_message(message: types.Message, state: FSMContext):
     await save_user_data(user_id, user_data[user_id])
 
 @router.callback_query()
+@timed("handle_callback")
 async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
+    started = time.perf_counter()
     user_id = callback.from_user.id
     action = callback.data
     logger.info(f"Пользователь {user_id}: Нажата кнопка: {action}")
-    await callback.message.bot.send_chat_action(chat_id=callback.message.chat.id, action="typing")
-    await asyncio.sleep(0.5)
     user_data[user_id] = user_data.get(user_id, {
         "history": [],
         "active_topic": None,
@@ -726,10 +741,17 @@ async def handle_callback(callback: types.CallbackQuery, state: FSMContext):
     elif action == "cancel_feedback":
         await cancel_feedback_callback(callback, state)
         return
+    quota_exceeded = check_quota(user_id)
+    if quota_exceeded:
+        await callback.message.answer(get_quota_reply(user_id, quota_exceeded), parse_mode="HTML")
+        await callback.answer()
+        return
     history = user_data[user_id]["history"]
     active_topic = user_data[user_id]["active_topic"]
-    response = await get_unlim_response(user_id, action, history, is_code_request=False, search_data=None)
+    async with ChatActionSender.typing(bot=callback.message.bot, chat_id=callback.message.chat.id, interval=TYPING_ACTION_INTERVAL):
+        response = await get_unlim_response(user_id, action, history, is_code_request=False, search_data=None)
     await send_long_message(callback.message, response, parse_mode="HTML")
+    RESPONSE_SECONDS.observe(time.perf_counter() - started, get_tier(user_id))
     history.append({"role": "assistant", "content": response})
     user_data[user_id]["history"] = history[-20:]
     user_data[user_id]["active_topic"] = extract_topic(response)
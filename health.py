@@ -0,0 +1,72 @@
+import logging
+import asyncio
+import os
+import time
+from aiogram import Bot
+from metrics import EVENT_LOOP_LAG
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_REFRESH_INTERVAL = float(os.getenv("WEBHOOK_REFRESH_INTERVAL", 60))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+
+class HealthMonitor:
+    def __init__(self, refresh_interval: float, lag_interval: float):
+        self.refresh_interval = refresh_interval
+        self.lag_interval = lag_interval
+        self.webhook_url = None
+        self.pending_updates = None
+        self.webhook_error = None
+        self.checked_at = None
+        self.loop_lag = 0.0
+        self.tasks = []
+
+    @property
+    def bot_ready(self) -> bool:
+        return self.checked_at is not None and self.webhook_error is None
+
+    def start(self, bot: Bot):
+        self.tasks = [
+            asyncio.create_task(self._refresh_webhook(bot)),
+            asyncio.create_task(self._measure_loop_lag()),
+        ]
+        logger.info("Фоновый мониторинг здоровья запущен")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def snapshot(self) -> dict:
+        return {
+            "bot_ready": self.bot_ready,
+            "webhook_url": self.webhook_url,
+            "pending_updates": self.pending_updates,
+            "webhook_checked_at": self.checked_at,
+            "webhook_error": self.webhook_error,
+        }
+
+    async def _refresh_webhook(self, bot: Bot):
+        while True:
+            try:
+                info = await bot.get_webhook_info()
+                self.webhook_url = info.url
+                self.pending_updates = info.pending_update_count
+                self.webhook_error = None
+                self.checked_at = time.time()
+                logger.debug(f"Статус webhook обновлён: url={info.url}, pending_updates={info.pending_update_count}")
+            except Exception as e:
+                self.webhook_error = str(e)
+                logger.warning(f"Не удалось обновить статус webhook: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def _measure_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.loop_lag = max(0.0, loop.time() - started - self.lag_interval)
+            EVENT_LOOP_LAG.set(self.loop_lag)
+
+health_monitor = HealthMonitor(WEBHOOK_REFRESH_INTERVAL, LOOP_LAG_INTERVAL)
\ No newline at end of file
@@ -0,0 +1,71 @@
+import logging
+import json
+import os
+import random
+import re
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_BASE_PATH = os.getenv("KNOWLEDGE_BASE_PATH", "./knowledge_base.json")
+
+DEFAULT_FALLBACK_TEXT = "Я немного занята, но очень хочу тебе ответить! 😊 Напиши мне ещё раз чуть позже."
+
+mood_keywords = {
+    "negative": [
+        "грустн", "плохо", "устал", "тревог", "тревож", "одинок", "стресс", "злюсь", "бесит",
+        "депресс", "страшно", "боюсь", "не могу", "тяжело", "😔", "😢", "😞", "😭",
+    ],
+    "positive": [
+        "отлично", "рад", "счастлив", "круто", "супер", "класс", "ура", "здорово", "😊", "😄", "🎉",
+    ],
+}
+
+knowledge_base = None
+
+def load_knowledge_base() -> dict:
+    global knowledge_base
+    if knowledge_base is None:
+        try:
+            with open(KNOWLEDGE_BASE_PATH, encoding="utf-8") as f:
+                knowledge_base = json.load(f)
+            logger.info(f"База знаний загружена: {len(knowledge_base.get('intents', []))} интентов")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки базы знаний {KNOWLEDGE_BASE_PATH}: {e}")
+            knowledge_base = {"intents": [], "fallback_response": {"text": DEFAULT_FALLBACK_TEXT}}
+    return knowledge_base
+
+def normalize_text(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    return " ".join(re.findall(r"\w+", text))
+
+def detect_mood(text: str) -> str:
+    text_lower = text.lower()
+    for mood, keywords in mood_keywords.items():
+        if any(keyword in text_lower for keyword in keywords):
+            return mood
+    return "neutral"
+
+def get_stems(text: str) -> set:
+    return {word[:5] for word in normalize_text(text).split()}
+
+def match_intent(text: str):
+    stems = get_stems(text)
+    best_intent = None
+    best_score = 0
+    for intent in load_knowledge_base().get("intents", []):
+        for pattern in intent.get("patterns", []):
+            pattern_stems = get_stems(pattern)
+            if pattern_stems and pattern_stems <= stems and len(pattern_stems) > best_score:
+                best_intent = intent
+                best_score = len(pattern_stems)
+    return best_intent
+
+def get_canned_reply(text: str) -> str:
+    base = load_knowledge_base()
+    intent = match_intent(text)
+    if intent and intent.get("responses"):
+        mood = detect_mood(text)
+        responses = [r for r in intent["responses"] if r.get("mood") == mood] or intent["responses"]
+        logger.info(f"Ответ из базы знаний: интент {intent.get('intent')}, настроение {mood}")
+        return random.choice(responses)["text"]
+    return base.get("fallback_response", {}).get("text", DEFAULT_FALLBACK_TEXT)
\ No newline at end of file
@@ -1,13 +1,27 @@
 import logging
+import asyncio
 import json
 from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import uvicorn
 from aiogram import Bot, Dispatcher, Router
 from contextlib import asynccontextmanager
 import os
+import urllib.parse
 from dotenv import load_dotenv
 from handlers import router  # Импорт роутера из handlers
-from database import init_firebase
+from miniapp import api_router
+from database import load_storage, storage_ready, message_outbox
+from state import user_data
+from utils import processed_updates
+from metrics import timed, in_flight, render, Gauge, UPDATES_TOTAL, UPDATES_IN_FLIGHT, LLM_IN_FLIGHT
+from health import health_monitor
+from admission import llm_admission
+from usage import usage_aggregator
+from openrouter import start_client, close_client, POOL_SATURATION
+from recorder import traffic_recorder
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,16 +42,52 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 if not TELEGRAM_TOKEN:
     logger.error("TELEGRAM_TOKEN не указан в .env")
     exit(1)
-bot = Bot(token=TELEGRAM_TOKEN)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    # Локальный Bot API или заглушка из stub_servers.py
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    bot = Bot(token=TELEGRAM_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    logger.info(f"Bot API: {TELEGRAM_API_URL}")
+else:
+    bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
 
-# Регистрация роутера и Firebase
+# Регистрация роутера
 dp.include_router(router)
-init_firebase()
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    logger.info("Запуск lifespan: настройка webhook и загрузка данных")
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 20))
+READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", 1.0))
+READY_MAX_ARCHIVE_BACKLOG = int(os.getenv("READY_MAX_ARCHIVE_BACKLOG", 1000))
+
+USERS_IN_MEMORY = Gauge("emma_users_in_memory", "Пользователи в user_data", callback=lambda: len(user_data))
+PROCESSED_UPDATES = Gauge("emma_processed_updates", "Размер множества processed_updates", callback=lambda: len(processed_updates))
+
+draining = False
+
+async def drain_updates():
+    # uvicorn до shutdown уже ждёт текущие запросы (не дольше --timeout-graceful-shutdown);
+    # здесь дожидаемся обновлений, которые ещё дорабатывают, и отвечаем 503 на запоздавшие
+    global draining
+    draining = True
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + DRAIN_TIMEOUT
+    updates_at_start = UPDATES_IN_FLIGHT.get()
+    logger.info(f"Начат drain: обновлений в обработке {updates_at_start}, сообщений в архиве {message_outbox.pending}")
+    while UPDATES_IN_FLIGHT.get() > 0 and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+    updates_abandoned = UPDATES_IN_FLIGHT.get()
+    logger.info(f"Drain обновлений: завершено {updates_at_start - updates_abandoned}, брошено {updates_abandoned}")
+
+async def drain_archive():
+    archive_pending = message_outbox.pending
+    archive_abandoned = await message_outbox.drain(DRAIN_TIMEOUT)
+    logger.info(f"Drain архива: сохранено {max(archive_pending - len(archive_abandoned), 0)}, брошено {len(archive_abandoned)}")
+    if archive_abandoned:
+        logger.warning(f"Не сохранены сообщения: {archive_abandoned}")
+    await usage_aggregator.stop()
+
+async def register_webhook():
     try:
         render_url = os.getenv("RENDER_URL", "emma-bot-render.onrender.com")
         webhook_url = f"https://{render_url}/webhook"
@@ -49,7 +99,28 @@ async def lifespan(app: FastAPI):
         await set_bot_commands(bot)
     except Exception as e:
         logger.error(f"Ошибка в lifespan (startup): {e}", exc_info=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("Запуск lifespan: настройка webhook и загрузка данных")
+    startup_tasks = [
+        asyncio.create_task(load_storage()),
+        asyncio.create_task(register_webhook()),
+        asyncio.create_task(start_client()),
+    ]
+    message_outbox.start()
+    usage_aggregator.start()
+    health_monitor.start(bot)
+    traffic_recorder.start()
     yield
+    await drain_updates()
+    for task in startup_tasks:
+        task.cancel()
+    await asyncio.gather(*startup_tasks, return_exceptions=True)
+    await health_monitor.stop()
+    await drain_archive()
+    await traffic_recorder.stop()
+    await close_client()
     try:
         await bot.delete_webhook()
         await bot.session.close()
@@ -58,51 +129,87 @@ async def lifespan(app: FastAPI):
         logger.error(f"Ошибка в lifespan (shutdown): {e}", exc_info=True)
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(GZipMiddleware, minimum_size=500)
+MINIAPP_URL = os.getenv("MINIAPP_URL")
+if MINIAPP_URL:
+    miniapp_origin = urllib.parse.urlsplit(MINIAPP_URL)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=[f"{miniapp_origin.scheme}://{miniapp_origin.netloc}"],
+        allow_methods=["GET"],
+        allow_headers=["Authorization", "If-None-Match"],
+        expose_headers=["ETag"],
+    )
+app.include_router(api_router)
 
 @app.get("/health")
 @app.head("/health")
 async def health_check():
-    logger.info("Запрос к /health")
-    try:
-        info = await bot.get_webhook_info()
-        logger.info(f"Health check успешен: webhook_url={info.url}, pending_updates={info.pending_update_count}")
-        return {
-            "status": "ok",
-            "bot_ready": True,
-            "webhook_url": info.url,
-            "pending_updates": info.pending_update_count,
-        }
-    except Exception as e:
-        logger.error(f"Ошибка в health check: {e}", exc_info=True)
-        return {"status": "error", "bot_ready": False, "error": str(e)}
+    return {"status": "ok", **health_monitor.snapshot()}
+
+@app.get("/ready")
+async def readiness_check():
+    archive_backlog = message_outbox.pending
+    ready = not draining and storage_ready.is_set() and health_monitor.loop_lag <= READY_MAX_LOOP_LAG and archive_backlog <= READY_MAX_ARCHIVE_BACKLOG
+    return JSONResponse(
+        {
+            "ready": ready,
+            "draining": draining,
+            "storage_loaded": storage_ready.is_set(),
+            "event_loop_lag": round(health_monitor.loop_lag, 4),
+            "updates_in_flight": UPDATES_IN_FLIGHT.get(),
+            "llm_in_flight": LLM_IN_FLIGHT.get(),
+            "llm_queue_depth": llm_admission.queue_depth,
+            "openrouter_pool_saturation": round(POOL_SATURATION.get(), 3),
+            "archive_backlog": archive_backlog,
+        },
+        status_code=200 if ready else 503,
+    )
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
 
 @app.post("/webhook")
+@timed("webhook")
+@in_flight(UPDATES_IN_FLIGHT)
 async def webhook(request: Request):
     logger.debug(f"Получен webhook запрос: headers={request.headers}")
+    if draining:
+        UPDATES_TOTAL.inc("rejected")
+        return JSONResponse({"status": "error", "message": "Shutting down"}, status_code=503)
+    if not storage_ready.is_set():
+        await storage_ready.wait()
     try:
         body = await request.body()
         logger.debug(f"Тело запроса: {body}")
         if not body:
             logger.error("Пустое тело запроса")
+            UPDATES_TOTAL.inc("error")
             return {"status": "error", "message": "Empty request body"}
         update = await request.json()
         logger.debug(f"Получен update: {update}")
+        traffic_recorder.record(update)
         update_id = update.get("update_id")
         from utils import processed_updates
         if update_id in processed_updates:
             logger.info(f"Повторный update_id: {update_id}, пропущен")
+            UPDATES_TOTAL.inc("duplicate")
             return {"status": "ok"}
         processed_updates.add(update_id)
         await dp.feed_raw_update(bot, update)
         logger.debug("Update успешно обработан")
+        UPDATES_TOTAL.inc("processed")
         return {"status": "ok"}
     except json.JSONDecodeError as e:
         logger.error(f"Ошибка декодирования JSON: {e}")
+        UPDATES_TOTAL.inc("error")
         return {"status": "error", "message": f"JSON decode error: {str(e)}"}
     except Exception as e:
         logger.error(f"Ошибка обработки webhook: {e}", exc_info=True)
+        UPDATES_TOTAL.inc("error")
         return {"status": "error", "message": str(e)}
 
 if __name__ == "__main__":
     logger.info("Запуск приложения через uvicorn")
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)), workers=1)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)), workers=1, timeout_graceful_shutdown=int(DRAIN_TIMEOUT))
\ No newline at end of file
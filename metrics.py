@@ -0,0 +1,173 @@
+import asyncio
+import bisect
+import functools
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+registry = []
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labelnames, labelvalues, extra=None) -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        for labelvalues, value in list(self.values.items()):
+            yield self.name, format_labels(self.labelnames, labelvalues), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues):
+        return self.values.get(labelvalues, 0)
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, *labelvalues):
+        self.values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) - amount
+
+    def get(self, *labelvalues):
+        if self.callback is not None:
+            return self.callback()
+        return self.values.get(labelvalues, 0)
+
+    def samples(self):
+        if self.callback is not None:
+            yield self.name, "", self.callback()
+        else:
+            yield from super().samples()
+
+class Timer:
+    __slots__ = ("histogram", "labelvalues", "start", "elapsed")
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, *self.labelvalues)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            STAGE_ERRORS.inc(*self.labelvalues)
+        return False
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        state = self.values.get(labelvalues)
+        if state is None:
+            state = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def time(self, *labelvalues) -> Timer:
+        return Timer(self, labelvalues)
+
+    def count(self, *labelvalues) -> int:
+        state = self.values.get(labelvalues)
+        return state[2] if state else 0
+
+    def quantile(self, q: float, *labelvalues):
+        state = self.values.get(labelvalues)
+        if not state or not state[2]:
+            return None
+        rank = q * state[2]
+        cumulative = 0
+        lower = 0.0
+        for i, bucket_count in enumerate(state[0]):
+            upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+            if bucket_count and cumulative + bucket_count >= rank:
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = upper
+        return self.buckets[-1]
+
+    def samples(self):
+        for labelvalues, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", format_labels(self.labelnames, labelvalues, f'le="{bound}"'), cumulative
+            yield f"{self.name}_bucket", format_labels(self.labelnames, labelvalues, 'le="+Inf"'), count
+            yield f"{self.name}_sum", format_labels(self.labelnames, labelvalues), total
+            yield f"{self.name}_count", format_labels(self.labelnames, labelvalues), count
+
+def timed(stage: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def in_flight(gauge):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            gauge.inc()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                gauge.dec()
+        return wrapper
+    return decorator
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+STAGE_SECONDS = Histogram("emma_stage_duration_seconds", "Длительность этапов обработки", ["stage"])
+STAGE_ERRORS = Counter("emma_stage_errors_total", "Ошибки на этапах обработки", ["stage"])
+UPDATES_TOTAL = Counter("emma_updates_total", "Полученные webhook-обновления", ["status"])
+OPENROUTER_ATTEMPTS = Counter("emma_openrouter_attempts_total", "Попытки запросов к OpenRouter", ["outcome"])
+CSE_RESULTS = Counter("emma_cse_results_total", "Результаты Google CSE после фильтрации", ["outcome"])
+UPDATES_IN_FLIGHT = Gauge("emma_updates_in_flight", "Webhook-обновления в обработке")
+LLM_IN_FLIGHT = Gauge("emma_llm_in_flight", "Запросы к LLM в процессе")
+EVENT_LOOP_LAG = Gauge("emma_event_loop_lag_seconds", "Задержка event loop")
+LLM_TOKENS = Counter("emma_llm_tokens_total", "Токены LLM по данным usage", ["kind"])
\ No newline at end of file
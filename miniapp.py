@@ -0,0 +1,48 @@
+import logging
+import hashlib
+import os
+import time
+from fastapi import APIRouter, Header, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from aiogram.utils.web_app import safe_parse_webapp_init_data
+from database import get_archived_message
+from state import recent_messages
+
+logger = logging.getLogger(__name__)
+
+api_router = APIRouter()
+
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+MINIAPP_INIT_DATA_MAX_AGE = int(os.getenv("MINIAPP_INIT_DATA_MAX_AGE", 86400))
+
+def authenticate(authorization: str):
+    if not authorization or not authorization.startswith("tma "):
+        raise HTTPException(status_code=401, detail="Missing init data")
+    try:
+        init_data = safe_parse_webapp_init_data(TELEGRAM_TOKEN, authorization[4:])
+    except ValueError:
+        logger.warning("Невалидный initData в запросе мини-аппки")
+        raise HTTPException(status_code=401, detail="Invalid init data")
+    if MINIAPP_INIT_DATA_MAX_AGE and time.time() - init_data.auth_date.timestamp() > MINIAPP_INIT_DATA_MAX_AGE:
+        raise HTTPException(status_code=401, detail="Init data expired")
+    if not init_data.user:
+        raise HTTPException(status_code=401, detail="Missing user")
+    return init_data
+
+@api_router.get("/api/messages/{message_id}")
+async def get_message(message_id: str, request: Request, authorization: str = Header(None)):
+    init_data = authenticate(authorization)
+    message = recent_messages.get(message_id)
+    if message is None:
+        message = await get_archived_message(message_id)
+        if message is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+        recent_messages.set(message_id, message)
+    if message["user_id"] != str(init_data.user.id):
+        logger.warning(f"Пользователь {init_data.user.id} запросил чужое сообщение {message_id}")
+        raise HTTPException(status_code=404, detail="Message not found")
+    etag = f'"{hashlib.sha1(message["text"].encode()).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"message_id": message_id, "text": message["text"]}, headers=headers)
\ No newline at end of file
@@ -0,0 +1,107 @@
+import logging
+import asyncio
+import importlib.util
+import os
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", 20))
+OPENROUTER_MAX_KEEPALIVE = int(os.getenv("OPENROUTER_MAX_KEEPALIVE", 10))
+OPENROUTER_KEEPALIVE_EXPIRY = float(os.getenv("OPENROUTER_KEEPALIVE_EXPIRY", 120))
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", 5))
+OPENROUTER_READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", 60))
+OPENROUTER_POOL_TIMEOUT = float(os.getenv("OPENROUTER_POOL_TIMEOUT", 10))
+OPENROUTER_PREWARM_CONNECTIONS = int(os.getenv("OPENROUTER_PREWARM_CONNECTIONS", 2))
+# HTTP/2 требует пакет h2; без него остаёмся на HTTP/1.1 с keep-alive
+OPENROUTER_HTTP2 = os.getenv("OPENROUTER_HTTP2", "auto").lower() != "off" and importlib.util.find_spec("h2") is not None
+
+POOL_REQUESTS = Counter("emma_openrouter_pool_requests_total", "HTTP-запросы через пул соединений OpenRouter", ["outcome"])
+POOL_IN_FLIGHT = Gauge("emma_openrouter_pool_in_flight", "HTTP-запросы к OpenRouter, занимающие соединение пула")
+POOL_SATURATION = Gauge(
+    "emma_openrouter_pool_saturation",
+    "Доля занятых соединений пула OpenRouter",
+    callback=lambda: POOL_IN_FLIGHT.get() / max(OPENROUTER_MAX_CONNECTIONS, 1),
+)
+
+client = None
+http_client = None
+
+def create_transport():
+    import httpx
+
+    class InstrumentedTransport(httpx.AsyncHTTPTransport):
+        # Считаем запрос занятым до получения заголовков ответа: openai сразу дочитывает тело
+        async def handle_async_request(self, request):
+            POOL_IN_FLIGHT.inc()
+            try:
+                response = await super().handle_async_request(request)
+            except Exception:
+                POOL_REQUESTS.inc("error")
+                raise
+            finally:
+                POOL_IN_FLIGHT.dec()
+            POOL_REQUESTS.inc("ok")
+            return response
+
+    return InstrumentedTransport(
+        http2=OPENROUTER_HTTP2,
+        limits=httpx.Limits(
+            max_connections=OPENROUTER_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENROUTER_MAX_KEEPALIVE,
+            keepalive_expiry=OPENROUTER_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+def get_client():
+    global client, http_client
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        http_client = httpx.AsyncClient(
+            transport=create_transport(),
+            timeout=httpx.Timeout(
+                OPENROUTER_READ_TIMEOUT,
+                connect=OPENROUTER_CONNECT_TIMEOUT,
+                pool=OPENROUTER_POOL_TIMEOUT,
+            ),
+        )
+        client = AsyncOpenAI(
+            # Ключ читаем при создании: telegram_bot.py вызывает load_dotenv после импортов
+            api_key=os.getenv("OPENROUTER_API_KEY"),
+            base_url=OPENROUTER_BASE_URL,
+            http_client=http_client,
+            max_retries=0,
+        )
+        logger.info(
+            f"OpenRouter API клиент инициализирован: {OPENROUTER_BASE_URL}, "
+            f"соединений до {OPENROUTER_MAX_CONNECTIONS}, HTTP/2 {'вкл' if OPENROUTER_HTTP2 else 'выкл'}"
+        )
+    return client
+
+async def prewarm():
+    # DNS, TCP и TLS до первого пользовательского запроса; /models не требует ключа
+    get_client()
+    results = await asyncio.gather(
+        *(http_client.get(f"{OPENROUTER_BASE_URL}/models", timeout=OPENROUTER_CONNECT_TIMEOUT * 2) for _ in range(OPENROUTER_PREWARM_CONNECTIONS)),
+        return_exceptions=True,
+    )
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        logger.warning(f"Прогрев соединений OpenRouter: {len(failed)} из {len(results)} неудачно: {failed[0]}")
+    else:
+        logger.info(f"Прогрето соединений OpenRouter: {len(results)}")
+
+async def start_client():
+    get_client()
+    if OPENROUTER_PREWARM_CONNECTIONS > 0:
+        await prewarm()
+
+async def close_client():
+    global client, http_client
+    if client is not None:
+        await client.close()
+        client = None
+        http_client = None
+        logger.info("OpenRouter API клиент закрыт")
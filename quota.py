@@ -0,0 +1,123 @@
+import logging
+import os
+import time
+from datetime import datetime
+from state import user_data
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+TIERS = {
+    "free": {
+        "daily_limit": int(os.getenv("FREE_DAILY_LIMIT", 20)),
+        "rate_per_minute": float(os.getenv("FREE_RATE_PER_MINUTE", 4)),
+        "burst": int(os.getenv("FREE_BURST", 3)),
+    },
+    "premium": {
+        "daily_limit": int(os.getenv("PREMIUM_DAILY_LIMIT", 50)),
+        "rate_per_minute": float(os.getenv("PREMIUM_RATE_PER_MINUTE", 10)),
+        "burst": int(os.getenv("PREMIUM_BURST", 5)),
+    },
+}
+MAX_TRACKED_BUCKETS = int(os.getenv("MAX_TRACKED_BUCKETS", 10000))
+FULL_REFILL_SECONDS = max(60 * tier["burst"] / tier["rate_per_minute"] for tier in TIERS.values())
+
+QUOTA_REJECTIONS = Counter("emma_quota_rejections_total", "Запросы, отклонённые лимитами", ["tier", "reason"])
+
+# user_id -> [токены, время последнего пополнения]
+buckets = {}
+# user_id -> {"day", "used"}; вне user_data, чтобы /start и /clear не обнуляли дневной лимит
+daily_counters = {}
+
+def get_expiry_timestamp(expiry):
+    # handlers.py хранит timestamp, а telegram_bot.py пишет в Firestore datetime
+    if isinstance(expiry, datetime):
+        return expiry.timestamp()
+    if isinstance(expiry, (int, float)):
+        return float(expiry)
+    if isinstance(expiry, str):
+        try:
+            return float(expiry)
+        except ValueError:
+            pass
+        try:
+            return datetime.fromisoformat(expiry).timestamp()
+        except ValueError:
+            logger.warning(f"Не удалось разобрать срок подписки: {expiry!r}")
+    return None
+
+def is_premium_active(data: dict) -> bool:
+    if not data.get("premium"):
+        return False
+    expiry = get_expiry_timestamp(data.get("expiry"))
+    return expiry is not None and expiry > time.time()
+
+def get_tier(user_id: int) -> str:
+    return "premium" if is_premium_active(user_data.get(user_id, {})) else "free"
+
+def prune_buckets(now: float):
+    for user_id in [user_id for user_id, (_, updated_at) in buckets.items() if now - updated_at >= FULL_REFILL_SECONDS]:
+        del buckets[user_id]
+
+def take_token(user_id: int, tier: dict) -> bool:
+    now = time.monotonic()
+    bucket = buckets.get(user_id)
+    if bucket is None:
+        if len(buckets) >= MAX_TRACKED_BUCKETS:
+            prune_buckets(now)
+        bucket = buckets[user_id] = [tier["burst"], now]
+    tokens = min(tier["burst"], bucket[0] + (now - bucket[1]) * tier["rate_per_minute"] / 60)
+    bucket[1] = now
+    if tokens < 1:
+        bucket[0] = tokens
+        return False
+    bucket[0] = tokens - 1
+    return True
+
+def prune_daily_counters(day: str):
+    # Вчерашние счётчики не нужны, а совпадающий с копией в профиле восстановится из неё
+    for user_id in [
+        user_id for user_id, counter in daily_counters.items()
+        if counter["day"] != day or user_data.get(user_id, {}).get("quota") is counter
+    ]:
+        del daily_counters[user_id]
+
+def get_daily_counter(user_id: int, day: str) -> dict:
+    quota = daily_counters.get(user_id)
+    if quota is None:
+        if len(daily_counters) >= MAX_TRACKED_BUCKETS:
+            prune_daily_counters(day)
+        # После перезапуска продолжаем со счётчика, загруженного из Firestore
+        saved = user_data.get(user_id, {}).get("quota")
+        quota = daily_counters[user_id] = dict(saved) if saved else {"day": day, "used": 0}
+    if quota.get("day") != day:
+        quota.update(day=day, used=0)
+    return quota
+
+def check_quota(user_id: int):
+    tier_name = get_tier(user_id)
+    tier = TIERS[tier_name]
+    day = datetime.now().strftime("%Y-%m-%d")
+    quota = get_daily_counter(user_id, day)
+    # Копия в профиле только для сохранения в Firestore, источник истины — daily_counters
+    user_data.setdefault(user_id, {})["quota"] = quota
+    if quota["used"] >= tier["daily_limit"]:
+        QUOTA_REJECTIONS.inc(tier_name, "daily")
+        logger.info(f"Дневной лимит ({tier['daily_limit']}) исчерпан для пользователя {user_id} ({tier_name})")
+        return "daily"
+    if not take_token(user_id, tier):
+        QUOTA_REJECTIONS.inc(tier_name, "rate")
+        logger.info(f"Превышена частота запросов для пользователя {user_id} ({tier_name})")
+        return "rate"
+    quota["used"] += 1
+    return None
+
+def get_quota_reply(user_id: int, reason: str) -> str:
+    if reason == "rate":
+        return "Ты пишешь очень быстро! 😊 Дай мне пару секунд собраться с мыслями и напиши ещё раз."
+    if get_tier(user_id) == "premium":
+        return "На сегодня лимит запросов исчерпан. 💛 Давай продолжим завтра — я буду ждать!"
+    return (
+        "Бесплатный лимит запросов на сегодня закончился. 😔\n\n"
+        "Чтобы продолжить общение без ожидания, загляни в /pay — там можно оформить подписку. 💖"
+    )
@@ -0,0 +1,129 @@
+import logging
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import re
+import time
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+RECORD_UPDATES_PATH = os.getenv("RECORD_UPDATES_PATH", "")
+RECORD_UPDATES_MAX_QUEUE = int(os.getenv("RECORD_UPDATES_MAX_QUEUE", 10000))
+RECORD_UPDATES_FLUSH_INTERVAL = float(os.getenv("RECORD_UPDATES_FLUSH_INTERVAL", 5))
+# Постоянная соль сохраняет псевдонимы пользователей между перезапусками
+RECORD_UPDATES_SALT = os.getenv("RECORD_UPDATES_SALT", "").encode() or os.urandom(16)
+
+RECORDED_UPDATES = Counter("emma_recorded_updates_total", "Обновления, записанные для воспроизведения", ["outcome"])
+
+USER_KEYS = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat"}
+NAME_KEYS = {"first_name", "last_name", "username", "title", "phone_number", "email", "bio", "vcard", "address"}
+LOCATION_KEYS = {"location", "venue"}
+COORDINATE_KEYS = {"latitude", "longitude"}
+TEXT_KEYS = {"text", "caption", "query"}
+SECRET_KEYS = {"telegram_payment_charge_id", "provider_payment_charge_id", "file_id", "file_unique_id", "shipping_option_id", "chat_instance"}
+COMMAND = re.compile(r"^/\w+(@\w+)?")
+IDENTIFIER = re.compile(r"^[a-z0-9_]+$")
+
+def pseudonym(user_id: int) -> int:
+    digest = hmac.new(RECORD_UPDATES_SALT, str(abs(user_id)).encode(), hashlib.sha256).digest()
+    value = 10 ** 9 + int.from_bytes(digest[:8], "big") % (9 * 10 ** 9)
+    return -value if user_id < 0 else value
+
+def mask_text(text: str) -> str:
+    # Длина и границы слов сохраняются: от них зависят оценка токенов и нарезка сообщений
+    command = COMMAND.match(text)
+    prefix = command.group(0) if command else ""
+    return prefix + re.sub(r"\w", "x", text[len(prefix):])
+
+def anonymize(value, parent: str = None):
+    if isinstance(value, list):
+        return [anonymize(item, parent) for item in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key, item in value.items():
+        if key == "id" and parent in USER_KEYS and isinstance(item, int):
+            result[key] = pseudonym(item)
+        elif key == "user_id" and parent == "contact" and isinstance(item, int):
+            result[key] = pseudonym(item)
+        elif key in COORDINATE_KEYS and parent in LOCATION_KEYS:
+            # Координаты обнуляем: для воспроизведения важен лишь тип обновления
+            result[key] = 0.0
+        elif key in NAME_KEYS and isinstance(item, str):
+            result[key] = "User" if key == "first_name" else "anon"
+        elif key in TEXT_KEYS and isinstance(item, str):
+            result[key] = mask_text(item)
+        elif key == "data" and isinstance(item, str):
+            # Служебные callback_data (plan_1month и т.п.) нужны для воспроизведения, тексты подсказок маскируем
+            result[key] = item if IDENTIFIER.match(item) else mask_text(item)
+        elif key in SECRET_KEYS:
+            result[key] = ""
+        else:
+            result[key] = anonymize(item, key)
+    return result
+
+class TrafficRecorder:
+    def __init__(self, path: str, max_queue: int, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.task = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def start(self):
+        if self.enabled and self.task is None:
+            self.task = asyncio.create_task(self._run())
+            logger.info(f"Запись обновлений для воспроизведения в {self.path}")
+
+    def record(self, update: dict):
+        # Только постановка в очередь: анонимизация и запись на диск — в фоновой задаче
+        if self.task is None:
+            return
+        try:
+            self.queue.put_nowait((time.time(), update))
+        except asyncio.QueueFull:
+            RECORDED_UPDATES.inc("dropped")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+            await self.flush()
+
+    async def flush(self):
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self._write, batch)
+            RECORDED_UPDATES.inc("written", amount=len(batch))
+        except Exception as e:
+            RECORDED_UPDATES.inc("error", amount=len(batch))
+            logger.error(f"Ошибка записи {len(batch)} обновлений в {self.path}: {e}")
+
+    def _write(self, batch: list):
+        lines = "".join(
+            json.dumps({"t": round(arrived_at, 3), "update": anonymize(update)}, ensure_ascii=False) + "\n"
+            for arrived_at, update in batch
+        )
+        # Каждая порция — отдельный gzip-member; gzip.open читает такой файл целиком
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write(lines)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+traffic_recorder = TrafficRecorder(RECORD_UPDATES_PATH, RECORD_UPDATES_MAX_QUEUE, RECORD_UPDATES_FLUSH_INTERVAL)
+RECORDER_QUEUE = Gauge("emma_recorder_queue", "Обновления, ожидающие записи на диск", callback=lambda: traffic_recorder.queue.qsize())
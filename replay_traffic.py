@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import gzip
+import json
+import time
+import aiohttp
+from bench_webhook import (
+    add_stack_arguments, start_stack, stop_stack, fetch_text, parse_metrics, stage_timings,
+    percentiles, git_revision,
+)
+
+def load_records(path: str, limit: int = None) -> list:
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records.append((record["t"], record["update"]))
+    records.sort(key=lambda record: record[0])
+    return records[:limit] if limit else records
+
+def update_kind(update: dict) -> str:
+    if "callback_query" in update:
+        return "callback"
+    if "pre_checkout_query" in update:
+        return "pre_checkout"
+    message = update.get("message")
+    if message is None:
+        return "other"
+    if "successful_payment" in message:
+        return "payment"
+    text = message.get("text", "")
+    if text.startswith("/"):
+        return text.split()[0].split("@")[0]
+    return "text" if text else "other"
+
+def user_ids(records: list) -> list:
+    seen = {}
+    for _, update in records:
+        for key in ("message", "callback_query", "pre_checkout_query"):
+            user = (update.get(key) or {}).get("from") or {}
+            if user.get("id"):
+                seen.setdefault(user["id"], None)
+    return list(seen)
+
+async def prime_users(session: aiohttp.ClientSession, base_url: str, users: list, update_id: int):
+    # Воспроизводимые пользователи должны быть в состоянии waiting_for_message, как после /start
+    for user_id in users:
+        update_id += 1
+        update = {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+                "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            },
+        }
+        async with session.post(f"{base_url}/webhook", json=update) as response:
+            await response.read()
+
+async def replay(base_url: str, records: list, speed: float, max_connections: int, update_id_offset: int) -> dict:
+    latencies = {}
+    lags = []
+    outcomes = {}
+    connector = aiohttp.TCPConnector(limit=max_connections)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+        async def send(update: dict, scheduled_at: float):
+            lags.append(time.perf_counter() - scheduled_at)
+            try:
+                async with session.post(f"{base_url}/webhook", json=update) as response:
+                    body = await response.json(content_type=None)
+                    outcome = "ok" if response.status == 200 and body.get("status") == "ok" else f"http_{response.status}"
+            except Exception as e:
+                outcome = type(e).__name__
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            latencies.setdefault(update_kind(update), []).append(time.perf_counter() - scheduled_at)
+
+        tasks = []
+        first_arrival = records[0][0]
+        started = time.perf_counter()
+        for arrived_at, update in records:
+            scheduled_at = started + (arrived_at - first_arrival) / speed
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update = dict(update, update_id=update["update_id"] + update_id_offset)
+            tasks.append(asyncio.create_task(send(update, scheduled_at)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "sent_updates": len(all_latencies),
+        "recorded_span_s": round(records[-1][0] - first_arrival, 2),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(all_latencies) / elapsed, 1) if elapsed else 0,
+        "outcomes": outcomes,
+        "max_send_lag_ms": round(max(lags) * 1000, 1) if lags else 0,
+        "latency": percentiles(all_latencies),
+        "latency_by_kind": {kind: percentiles(values) for kind, values in sorted(latencies.items())},
+    }
+
+async def run(args) -> dict:
+    records = load_records(args.path, args.limit)
+    if not records:
+        raise RuntimeError(f"В {args.path} нет записанных обновлений")
+    processes = []
+    base_url = args.url
+    if base_url is None:
+        base_url, _, processes = start_stack(args)
+    # Сдвиг update_id, чтобы повторный прогон не отсеивался как дубликаты; дубликаты внутри записи сохраняются
+    update_id_offset = 0 if args.keep_update_ids else int(time.time()) * 10 ** 9
+    try:
+        async with aiohttp.ClientSession() as session:
+            if not args.no_prime:
+                await prime_users(session, base_url, user_ids(records), int(time.time() * 1000) * 1000)
+            before = parse_metrics(await fetch_text(session, f"{base_url}/metrics"))
+            load = await replay(base_url, records, args.speed, args.max_connections, update_id_offset)
+            after = parse_metrics(await fetch_text(session, f"{base_url}/metrics"))
+    finally:
+        stop_stack(processes)
+    return {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "source": args.path,
+        "speed": args.speed,
+        "load": load,
+        "stages": stage_timings(before, after),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных обновлений (RECORD_UPDATES_PATH) на /webhook")
+    parser.add_argument("path", help="файл .jsonl.gz от recorder.py")
+    parser.add_argument("--url", help="уже запущенный экземпляр; по умолчанию поднимаются заглушки и uvicorn")
+    parser.add_argument("--speed", type=float, default=1.0, help="множитель скорости: 1 — как в записи, 10 — в 10 раз быстрее")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--max-connections", type=int, default=500)
+    parser.add_argument("--keep-update-ids", action="store_true")
+    parser.add_argument("--no-prime", action="store_true", help="не отправлять /start за каждого пользователя перед прогоном")
+    parser.add_argument("--json", dest="json_path")
+    add_stack_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    load = report["load"]
+    print(f"Воспроизведено {load['sent_updates']} обновлений ({load['recorded_span_s']} с записи) за {load['elapsed_s']} с при скорости ×{args.speed}: {load['throughput_rps']} обн/с, исходы {load['outcomes']}")
+    print(f"Задержка: p50 {load['latency'].get('p50_ms')} мс, p95 {load['latency'].get('p95_ms')} мс, p99 {load['latency'].get('p99_ms')} мс; макс. отставание отправки {load['max_send_lag_ms']} мс")
+    for kind, entry in load["latency_by_kind"].items():
+        print(f"    {kind:<14} n={entry['count']:<6} p50 {entry['p50_ms']:>8} мс  p95 {entry['p95_ms']:>8} мс  p99 {entry['p99_ms']:>8} мс")
+    for stage, entry in report["stages"].items():
+        print(f"    {stage:<28} n={entry['count']:<6} среднее {entry['mean_ms']:>8} мс  p95 {entry['p95_ms']:>8} мс")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
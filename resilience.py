@@ -0,0 +1,233 @@
+import logging
+import asyncio
+import os
+import random
+import time
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+RETRY_ATTEMPTS = Counter("emma_retry_attempts_total", "Попытки вызовов внешних сервисов", ["dependency", "outcome"])
+CIRCUIT_STATE = Gauge("emma_circuit_state", "Состояние circuit breaker: 0 — закрыт, 1 — полуоткрыт, 2 — открыт", ["dependency"])
+CIRCUIT_REJECTIONS = Counter("emma_circuit_rejections_total", "Вызовы, отклонённые открытым circuit breaker", ["dependency"])
+
+RETRYABLE_STATUSES = {408, 425, 500, 502, 503, 504}
+
+class CircuitOpen(Exception):
+    pass
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+class HTTPStatusError(Exception):
+    def __init__(self, status: int, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def get_status(exc: Exception):
+    # openai: status_code, aiohttp: status, google.api_core: code
+    for attr in ("status_code", "status", "code"):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+def get_retry_after(exc: Exception):
+    retry_after = getattr(exc, "retry_after", None)
+    if retry_after is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+        retry_after = headers.get("retry-after")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except (TypeError, ValueError):
+        return None
+
+transport_errors = None
+
+def get_transport_errors() -> tuple:
+    # Сетевые ошибки клиентов не наследуют ConnectionError; импортируем лениво и только установленные
+    global transport_errors
+    if transport_errors is None:
+        errors = []
+        try:
+            import aiohttp
+            errors.append(aiohttp.ClientConnectionError)
+        except ImportError:
+            pass
+        try:
+            import httpx
+            errors.append(httpx.TransportError)
+        except ImportError:
+            pass
+        try:
+            import openai
+            errors.append(openai.APIConnectionError)
+        except ImportError:
+            pass
+        transport_errors = tuple(errors)
+    return transport_errors
+
+def classify_error(exc: Exception) -> str:
+    """Возвращает "rate_limited", "retryable" или "fatal"."""
+    status = get_status(exc)
+    if status == 429:
+        return "rate_limited"
+    if status in RETRYABLE_STATUSES:
+        return "retryable"
+    if status is not None and 400 <= status < 500:
+        return "fatal"
+    if isinstance(exc, (asyncio.TimeoutError, OSError) + get_transport_errors()):
+        return "retryable"
+    return "fatal"
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        CIRCUIT_STATE.set(0, name)
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def retry_in(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            # Пропускаем один пробный вызов, остальные ждут его результата
+            self.probing = True
+            CIRCUIT_STATE.set(1, self.name)
+            return True
+        CIRCUIT_REJECTIONS.inc(self.name)
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit breaker {self.name} закрыт")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        CIRCUIT_STATE.set(0, self.name)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f"Circuit breaker {self.name} открыт на {self.reset_timeout} с после {self.failures} ошибок подряд")
+            self.opened_at = time.monotonic()
+            self.probing = False
+            CIRCUIT_STATE.set(2, self.name)
+
+    def release_probe(self):
+        # Пробный вызов завершился ошибкой, не связанной со здоровьем сервиса
+        self.probing = False
+
+class RetryPolicy:
+    def __init__(self, name: str, max_attempts: int, base_delay: float, max_delay: float, deadline: float = None, breaker: CircuitBreaker = None):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker = breaker
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # Full jitter: равномерно от 0 до экспоненциальной границы
+        return random.uniform(0, min(self.base_delay * 2 ** attempt, self.max_delay))
+
+    async def call(self, func, *args, max_attempts: int = None, deadline: float = None, failover=None, **kwargs):
+        """failover(exc) -> True, если следующая попытка уйдёт на другой ресурс: тогда повторяем
+        даже после фатальной ошибки и без паузы — backoff нужен только для повторов в тот же ресурс."""
+        loop = asyncio.get_running_loop()
+        deadline = deadline if deadline is not None else self.deadline
+        expires_at = loop.time() + deadline if deadline is not None else None
+        max_attempts = max_attempts or self.max_attempts
+        for attempt in range(max_attempts):
+            if self.breaker is not None and not self.breaker.allow():
+                RETRY_ATTEMPTS.inc(self.name, "rejected")
+                raise CircuitOpen(f"{self.name}: circuit breaker открыт ещё {self.breaker.retry_in():.0f} с")
+            remaining = expires_at - loop.time() if expires_at is not None else None
+            try:
+                if remaining is None:
+                    result = await func(*args, **kwargs)
+                else:
+                    result = await asyncio.wait_for(func(*args, **kwargs), remaining)
+            except asyncio.CancelledError:
+                if self.breaker is not None:
+                    self.breaker.release_probe()
+                raise
+            except Exception as e:
+                kind = classify_error(e)
+                RETRY_ATTEMPTS.inc(self.name, kind)
+                if self.breaker is not None:
+                    if kind == "fatal":
+                        self.breaker.release_probe()
+                    else:
+                        self.breaker.record_failure()
+                switching = failover is not None and failover(e)
+                if (kind == "fatal" and not switching) or attempt == max_attempts - 1:
+                    raise
+                if switching:
+                    if expires_at is not None and loop.time() >= expires_at:
+                        raise DeadlineExceeded(f"{self.name}: дедлайн {deadline} с исчерпан") from e
+                    logger.warning(f"{self.name}: ошибка ({kind}), попытка {attempt + 1}/{max_attempts}, переключаемся без паузы: {e}")
+                    continue
+                delay = self.backoff(attempt, get_retry_after(e))
+                if expires_at is not None and loop.time() + delay >= expires_at:
+                    raise DeadlineExceeded(f"{self.name}: дедлайн {deadline} с исчерпан") from e
+                logger.warning(f"{self.name}: ошибка ({kind}), попытка {attempt + 1}/{max_attempts}, повтор через {delay:.1f} с: {e}")
+                await asyncio.sleep(delay)
+            else:
+                RETRY_ATTEMPTS.inc(self.name, "ok")
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+
+def breaker_from_env(name: str, prefix: str) -> CircuitBreaker:
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv(f"{prefix}_BREAKER_THRESHOLD", 5)),
+        reset_timeout=float(os.getenv(f"{prefix}_BREAKER_RESET", 30)),
+    )
+
+openrouter_retry = RetryPolicy(
+    "openrouter",
+    max_attempts=int(os.getenv("OPENROUTER_MAX_ATTEMPTS", 3)),
+    base_delay=float(os.getenv("OPENROUTER_RETRY_BASE_DELAY", 0.5)),
+    max_delay=float(os.getenv("OPENROUTER_RETRY_MAX_DELAY", 8)),
+    deadline=float(os.getenv("OPENROUTER_DEADLINE", 60)),
+    breaker=breaker_from_env("openrouter", "OPENROUTER"),
+)
+cse_retry = RetryPolicy(
+    "google_cse",
+    max_attempts=int(os.getenv("CSE_MAX_ATTEMPTS", 2)),
+    base_delay=float(os.getenv("CSE_RETRY_BASE_DELAY", 0.3)),
+    max_delay=float(os.getenv("CSE_RETRY_MAX_DELAY", 2)),
+    deadline=float(os.getenv("CSE_DEADLINE", 8)),
+    breaker=breaker_from_env("google_cse", "CSE"),
+)
+firestore_breaker = breaker_from_env("firestore", "FIRESTORE")
+firestore_retry = RetryPolicy(
+    "firestore",
+    max_attempts=int(os.getenv("FIRESTORE_MAX_ATTEMPTS", 3)),
+    base_delay=float(os.getenv("FIRESTORE_RETRY_BASE_DELAY", 0.2)),
+    max_delay=float(os.getenv("FIRESTORE_RETRY_MAX_DELAY", 2)),
+    deadline=float(os.getenv("FIRESTORE_DEADLINE", 10)),
+    breaker=firestore_breaker,
+)
@@ -1,6 +1,11 @@
+import os
 from aiogram.fsm.state import State, StatesGroup
+from cache import LRUCache
 
 user_data = {}
+file_id_cache = {}
+invoice_links = {}
+recent_messages = LRUCache(int(os.getenv("RECENT_MESSAGES_CACHE_SIZE", 1000)))
 
 class UserState(StatesGroup):
     waiting_for_message = State()
@@ -0,0 +1,265 @@
+# Локальные заглушки OpenRouter (OpenAI chat completions), Google CSE и Telegram Bot API
+# для нагрузочных тестов без расхода квоты OpenRouter и риска flood-бана в Telegram.
+# Все сервисы на одном порту; приложение направляется на них через окружение:
+#   OPENROUTER_BASE_URL=http://127.0.0.1:8081/openai/api/v1
+#   GOOGLE_CSE_URL=http://127.0.0.1:8081/cse/customsearch/v1
+#   TELEGRAM_API_URL=http://127.0.0.1:8081/telegram
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import time
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ("llm", "cse", "telegram")
+
+class Behavior:
+    def __init__(self, median: float, sigma: float, error_rate: float, rate_limit_rate: float):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+
+    def latency(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(self.median), self.sigma)
+
+    def outcome(self) -> str:
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            return "rate_limited"
+        if roll < self.rate_limit_rate + self.error_rate:
+            return "error"
+        return "ok"
+
+class StubState:
+    def __init__(self, behaviors: dict, reply_words: int):
+        self.behaviors = behaviors
+        self.reply_words = reply_words
+        self.stats = {service: {"ok": 0, "error": 0, "rate_limited": 0} for service in SERVICES}
+        self.methods = {}
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+
+    async def simulate(self, service: str) -> str:
+        behavior = self.behaviors[service]
+        await asyncio.sleep(behavior.latency())
+        outcome = behavior.outcome()
+        self.stats[service][outcome] += 1
+        return outcome
+
+WORDS = (
+    "конечно", "давай", "разберёмся", "это", "интересный", "вопрос", "вот", "что", "я", "думаю",
+    "смотри", "важно", "помнить", "главное", "не", "переживай", "всё", "получится", "😊", "💖",
+)
+
+def fake_reply(words: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def estimate_prompt_tokens(messages: list) -> int:
+    return sum(len(str(message.get("content", ""))) for message in messages) // 4 + 1
+
+# --- OpenAI / OpenRouter -------------------------------------------------------------------
+
+def openai_error(status: int, message: str) -> web.Response:
+    headers = {"Retry-After": "1"} if status == 429 else None
+    return web.json_response({"error": {"message": message, "code": status}}, status=status, headers=headers)
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    state = request.app["state"]
+    body = await request.json()
+    outcome = await state.simulate("llm")
+    if outcome == "rate_limited":
+        return openai_error(429, "Rate limit exceeded: free-models-per-min")
+    if outcome == "error":
+        return openai_error(502, "Upstream provider error")
+    model = body.get("model", "stub-model")
+    content = fake_reply(state.reply_words)
+    prompt_tokens = estimate_prompt_tokens(body.get("messages", []))
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(content) // 4 + 1,
+        "total_tokens": prompt_tokens + len(content) // 4 + 1,
+        "prompt_tokens_details": {"cached_tokens": 0},
+    }
+    completion_id = f"chatcmpl-stub-{next(state.message_ids)}"
+    created = int(time.time())
+    if not body.get("stream"):
+        return web.json_response({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    chunk_delay = state.behaviors["llm"].latency() / max(state.reply_words, 1)
+    for i, word in enumerate(content.split(" ")):
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {"role": "assistant", "content": word if i == 0 else " " + word}, "finish_reason": None}],
+        }
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        await asyncio.sleep(chunk_delay)
+    final = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        "usage": usage,
+    }
+    await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+    await response.write_eof()
+    return response
+
+async def list_models(request: web.Request) -> web.Response:
+    return web.json_response({"data": [{"id": "stub-model", "object": "model"}]})
+
+# --- Google CSE ----------------------------------------------------------------------------
+
+async def custom_search(request: web.Request) -> web.Response:
+    state = request.app["state"]
+    outcome = await state.simulate("cse")
+    if outcome == "rate_limited":
+        return web.json_response({"error": {"code": 429, "message": "Quota exceeded"}}, status=429)
+    if outcome == "error":
+        return web.json_response({"error": {"code": 503, "message": "Backend Error"}}, status=503)
+    query = request.query.get("q", "")
+    num = int(request.query.get("num", 7))
+    base = f"{request.scheme}://{request.host}"
+    items = [
+        {
+            "title": f"{query} — источник {i + 1}",
+            "link": f"{base}/cse/page/{i + 1}",
+            "snippet": f"{query}: {fake_reply(25)}",
+        }
+        for i in range(num)
+    ]
+    return web.json_response({"items": items})
+
+async def search_page(request: web.Request) -> web.Response:
+    # Цель check_link_status: HEAD должен отвечать 200
+    return web.Response(text="ok")
+
+# --- Telegram Bot API ----------------------------------------------------------------------
+
+def telegram_message(state: StubState, params: dict, **extra) -> dict:
+    chat_id = params.get("chat_id", 0)
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        pass
+    message = {
+        "message_id": int(params.get("message_id") or next(state.message_ids)),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": 1, "is_bot": True, "first_name": "Emma"},
+    }
+    message.update(extra)
+    return message
+
+def telegram_result(state: StubState, method: str, params: dict):
+    method = method.lower()
+    if method in ("sendmessage", "editmessagetext"):
+        return telegram_message(state, params, text=params.get("text", ""))
+    if method in ("sendphoto", "editmessagecaption"):
+        file_id = f"stub-photo-{next(state.file_ids)}"
+        photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 640, "height": 480}]
+        return telegram_message(state, params, photo=photo, caption=params.get("caption", ""))
+    if method == "sendinvoice":
+        return telegram_message(state, params, invoice={
+            "title": params.get("title", ""),
+            "description": params.get("description", ""),
+            "start_parameter": "",
+            "currency": params.get("currency", "XTR"),
+            "total_amount": 1,
+        })
+    if method == "createinvoicelink":
+        return f"https://t.me/$stub-invoice-{next(state.message_ids)}"
+    if method == "getme":
+        return {"id": 1, "is_bot": True, "first_name": "Emma", "username": "emma_stub_bot"}
+    if method == "getwebhookinfo":
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+    return True
+
+async def read_params(request: web.Request) -> dict:
+    if request.content_type == "application/json":
+        return await request.json()
+    params = {}
+    for key, value in (await request.post()).items():
+        params[key] = value if isinstance(value, str) else getattr(value, "filename", "")
+    params.update(request.query)
+    return params
+
+async def bot_api(request: web.Request) -> web.Response:
+    state = request.app["state"]
+    method = request.match_info["method"]
+    params = await read_params(request)
+    state.methods[method] = state.methods.get(method, 0) + 1
+    outcome = await state.simulate("telegram")
+    if outcome == "rate_limited":
+        return web.json_response(
+            {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}},
+            status=429,
+        )
+    if outcome == "error":
+        return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+    return web.json_response({"ok": True, "result": telegram_result(state, method, params)})
+
+async def stats(request: web.Request) -> web.Response:
+    state = request.app["state"]
+    return web.json_response({"services": state.stats, "telegram_methods": state.methods})
+
+def create_app(behaviors: dict, reply_words: int = 60) -> web.Application:
+    app = web.Application(client_max_size=20 * 1024 * 1024)
+    app["state"] = StubState(behaviors, reply_words)
+    app.router.add_post("/openai/api/v1/chat/completions", chat_completions)
+    app.router.add_get("/openai/api/v1/models", list_models)
+    app.router.add_get("/cse/customsearch/v1", custom_search)
+    app.router.add_route("*", "/cse/page/{page}", search_page)
+    app.router.add_route("*", "/telegram/bot{token}/{method}", bot_api)
+    app.router.add_get("/stub/stats", stats)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушки OpenRouter, Google CSE и Telegram Bot API для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--seed", type=int)
+    defaults = {"llm": (2.0, 0.6), "cse": (0.3, 0.4), "telegram": (0.05, 0.3)}
+    for service in SERVICES:
+        median, sigma = defaults[service]
+        parser.add_argument(f"--{service}-latency", type=float, default=median, help="медиана задержки, с")
+        parser.add_argument(f"--{service}-sigma", type=float, default=sigma, help="sigma логнормального распределения")
+        parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+        parser.add_argument(f"--{service}-429-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    options = vars(args)
+    behaviors = {
+        service: Behavior(
+            options[f"{service}_latency"], options[f"{service}_sigma"],
+            options[f"{service}_error_rate"], options[f"{service}_429_rate"],
+        )
+        for service in SERVICES
+    }
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger.info(f"Заглушки на http://{args.host}:{args.port}: {', '.join(SERVICES)}")
+    web.run_app(create_app(behaviors, args.reply_words), host=args.host, port=args.port, access_log=None)
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,8 @@ import asyncio
 import os
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from openai import DEFAULT_MAX_RETRIES
+from openrouter import get_client, start_client, close_client
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command, CommandStart
 from aiogram.types import BotCommand, InlineKeyboardMarkup, InlineKeyboardButton
@@ -67,12 +68,7 @@ if not TELEGRAM_TOKEN:
     exit(1)
 logging.info("Все переменные окружения проверены")
 
-# Настройка клиента OpenRouter API
-client = AsyncOpenAI(
-    api_key=OPENROUTER_API_KEY,
-    base_url="https://openrouter.ai/api/v1"
-)
-logging.info("OpenRouter API клиент инициализирован")
+# Клиент OpenRouter API общий с основным приложением (openrouter.py), создаётся в lifespan
 
 # Инициализация бота
 bot = Bot(token=TELEGRAM_TOKEN)
@@ -288,7 +284,9 @@ async def get_unlim_response(user_id: int, user_text: str, history: list, is_cod
                         f"Ссылка: {result['link']}\n\n"
                     )
                 messages.append({"role": "user", "content": search_content})
-            response = await client.chat.completions.create(
+            # Общий клиент создан без встроенных повторов (в utils.py их делает RetryPolicy),
+            # а этот цикл повторяет только 429 — возвращаем повторы openai по умолчанию
+            response = await get_client().with_options(max_retries=DEFAULT_MAX_RETRIES).chat.completions.create(
                 model=MODEL_NAME,
                 messages=messages,
                 temperature=0.3,
@@ -1221,6 +1219,7 @@ async def lifespan(app: FastAPI):
         info = await bot.get_webhook_info()
         logging.info(f"Webhook установлен: url={info.url}, pending_updates={info.pending_update_count}")
         await set_bot_commands()
+        await start_client()
         if db:
             try:
                 docs = db.collection('users').stream()
@@ -1238,6 +1237,7 @@ async def lifespan(app: FastAPI):
         logging.error(f"Ошибка в lifespan (startup): {e}", exc_info=True)
     yield
     try:
+        await close_client()
         await bot.delete_webhook()
         logging.info("Webhook удалён при завершении работы")
     except Exception as e:
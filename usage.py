@@ -0,0 +1,124 @@
+import logging
+import asyncio
+import os
+from datetime import datetime, timedelta
+from database import get_db
+from metrics import STAGE_SECONDS
+from resilience import RetryPolicy, firestore_retry, firestore_breaker
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", 60))
+
+COUNTER_FIELDS = ("requests", "prompt_tokens", "completion_tokens", "cached_tokens", "latency_ms", "admitted", "queue_wait_ms")
+
+def new_entry() -> dict:
+    entry = {field: 0 for field in COUNTER_FIELDS}
+    entry["models"] = {}
+    return entry
+
+def add_to_entry(entry: dict, delta: dict):
+    for field in COUNTER_FIELDS:
+        entry[field] += delta.get(field, 0)
+    for model, count in delta.get("models", {}).items():
+        entry["models"][model] = entry["models"].get(model, 0) + count
+
+def today() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+class UsageAggregator:
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.totals = {}
+        self.dirty = {}
+        self.task = None
+        # Increment не идемпотентен: без повторов и дедлайна, только общий breaker Firestore
+        self.retry = RetryPolicy("firestore_usage", max_attempts=1, base_delay=0, max_delay=0, breaker=firestore_breaker)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+            logger.info("Агрегатор использования токенов запущен")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+
+    def record(self, user_id: int, model: str, usage: dict, latency: float):
+        delta = {
+            "requests": 1,
+            "prompt_tokens": usage.get("prompt", 0),
+            "completion_tokens": usage.get("completion", 0),
+            "cached_tokens": usage.get("cached", 0),
+            "latency_ms": int(latency * 1000),
+            "models": {model: 1},
+        }
+        key = (user_id, today())
+        add_to_entry(self.totals.setdefault(key, new_entry()), delta)
+        add_to_entry(self.dirty.setdefault(key, new_entry()), delta)
+
+    def record_queue_wait(self, user_id: int, wait: float):
+        delta = {"admitted": 1, "queue_wait_ms": int(wait * 1000)}
+        key = (user_id, today())
+        add_to_entry(self.totals.setdefault(key, new_entry()), delta)
+        add_to_entry(self.dirty.setdefault(key, new_entry()), delta)
+
+    def top_users(self, day: str = None, limit: int = 10) -> list:
+        day = day or today()
+        entries = [(user_id, entry) for (user_id, entry_day), entry in self.totals.items() if entry_day == day]
+        entries.sort(key=lambda item: item[1]["prompt_tokens"] + item[1]["completion_tokens"], reverse=True)
+        return entries[:limit]
+
+    async def get_user_usage(self, user_id: int, day: str = None) -> dict:
+        day = day or today()
+        entry = new_entry()
+        try:
+            doc = await firestore_retry.call(asyncio.to_thread, get_db().collection("usage").document(f"{day}_{user_id}").get)
+            if doc.exists:
+                add_to_entry(entry, doc.to_dict())
+        except Exception as e:
+            logger.error(f"Ошибка чтения использования {user_id} за {day}: {e}")
+            add_to_entry(entry, self.totals.get((user_id, day), {}))
+            return entry
+        add_to_entry(entry, self.dirty.get((user_id, day), {}))
+        return entry
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        pending, self.dirty = self.dirty, {}
+        try:
+            with STAGE_SECONDS.time("firestore_usage"):
+                await self.retry.call(asyncio.to_thread, self._commit, pending)
+            logger.info(f"Использование токенов сохранено для {len(pending)} записей")
+        except Exception as e:
+            logger.error(f"Ошибка сохранения использования токенов: {e}")
+            for key, delta in pending.items():
+                add_to_entry(self.dirty.setdefault(key, new_entry()), delta)
+        oldest_day = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+        for key in [key for key in self.totals if key[1] < oldest_day]:
+            del self.totals[key]
+
+    def _commit(self, pending: dict):
+        from firebase_admin import firestore
+        db = get_db()
+        items = list(pending.items())
+        for start in range(0, len(items), 400):
+            write_batch = db.batch()
+            for (user_id, day), delta in items[start:start + 400]:
+                data = {"user_id": user_id, "day": day}
+                for field in COUNTER_FIELDS:
+                    data[field] = firestore.Increment(delta[field])
+                data["models"] = {model: firestore.Increment(count) for model, count in delta["models"].items()}
+                write_batch.set(db.collection("usage").document(f"{day}_{user_id}"), data, merge=True)
+            write_batch.commit()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+usage_aggregator = UsageAggregator(USAGE_FLUSH_INTERVAL)
@@ -1,33 +1,213 @@
 import logging
+import asyncio
+import hashlib
+import json
 import re
 import aiohttp
 import time
-from openai import AsyncOpenAI
-from bs4 import BeautifulSoup
 import os
-from database import save_user_data, save_message_to_firestore
-from state import user_data
-from aiogram import types
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+from collections import deque
+from database import save_user_data, save_file_id, message_outbox
+from state import user_data, file_id_cache, recent_messages
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, FSInputFile
+from admission import llm_admission, search_admission, Overloaded
+from openrouter import get_client
+from resilience import openrouter_retry, cse_retry, classify_error, CircuitOpen, HTTPStatusError
+from knowledge import get_canned_reply, normalize_text
+from cache import LRUCache
+from prompt import build_messages, apply_cache_hints, extract_usage, SYSTEM_PROMPT
+from usage import usage_aggregator
+from metrics import timed, in_flight, Counter, Gauge, Histogram, STAGE_SECONDS, OPENROUTER_ATTEMPTS, CSE_RESULTS, LLM_IN_FLIGHT, LLM_TOKENS
 
 logger = logging.getLogger(__name__)
 
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME", "openai/gpt-oss-120b:free")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")
+GOOGLE_CSE_URL = os.getenv("GOOGLE_CSE_URL", "https://www.googleapis.com/customsearch/v1")
 MINIAPP_URL = os.getenv("MINIAPP_URL")
 MINIAPP_BUTTON_TEXT = os.getenv("MINIAPP_BUTTON_TEXT", "🎀Просмотр🎀")
 NUM_SEARCH_RESULTS = int(os.getenv("NUM_SEARCH_RESULTS", 7))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 512))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_PROMPTS = os.getenv("RESPONSE_CACHE_PROMPTS", "")
+# Пул моделей через запятую; первая — основная. MODEL_ROUTES переопределяет порядок по классам запросов:
+# "code=model-a,model-b;long=model-c;short=model-d"
+MODEL_POOL = [model.strip() for model in os.getenv("MODEL_POOL", MODEL_NAME).split(",") if model.strip()]
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "")
+ROUTER_LONG_PROMPT_TOKENS = int(os.getenv("ROUTER_LONG_PROMPT_TOKENS", 6000))
+ROUTER_SHORT_TEXT_CHARS = int(os.getenv("ROUTER_SHORT_TEXT_CHARS", 80))
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", 50))
+ROUTER_WINDOW_SECONDS = float(os.getenv("ROUTER_WINDOW_SECONDS", 300))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", 5))
+ROUTER_MAX_P95 = float(os.getenv("ROUTER_MAX_P95", 30))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", 0.5))
+# Хеджирование: дублирующий запрос к другой модели, если ответ задерживается дольше p90
+LLM_HEDGING = os.getenv("LLM_HEDGING", "off").lower() in ("1", "on", "true")
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", 0.9))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 8))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 2))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", 30))
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", 0.1))
+HEDGE_BUDGET_BURST = float(os.getenv("HEDGE_BUDGET_BURST", 3))
 
-client = AsyncOpenAI(
-    api_key=OPENROUTER_API_KEY,
-    base_url="https://openrouter.ai/api/v1",
-)
-logger.info("OpenRouter API клиент инициализирован")
+ERROR_RESPONSE = "Извини, что-то пошло не так. 😔 Попробуй ещё раз или спроси что-то другое! 😊"
 
 processed_updates = set()
 
+# Вопросы, на которые поиск не нужен
+search_free_questions = ["сколько тебе лет", "как тебя зовут", "что ты помнишь обо мне"]
+
+# Вопросы, ответ на которые не зависит от истории диалога и может кэшироваться.
+# "Сколько тебе лет" сюда не входит: промпт велит обращаться по имени из истории
+cacheable_prompts = {
+    normalize_text(prompt)
+    for prompt in ["как тебя зовут", "кто ты", "что ты умеешь", *RESPONSE_CACHE_PROMPTS.split("|")]
+    if normalize_text(prompt)
+}
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+# Версия системного промпта в ключе: после его правки старые ответы не выдаются
+SYSTEM_PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT.encode()).hexdigest()[:12]
+
+RESPONSE_CACHE_REQUESTS = Counter("emma_response_cache_requests_total", "Обращения к кэшу ответов", ["result"])
+RESPONSE_CACHE_HIT_RATIO = Gauge(
+    "emma_response_cache_hit_ratio",
+    "Доля попаданий в кэш ответов",
+    callback=lambda: RESPONSE_CACHE_REQUESTS.get("hit") / max(RESPONSE_CACHE_REQUESTS.get("hit") + RESPONSE_CACHE_REQUESTS.get("miss"), 1),
+)
+RESPONSE_CACHE_ENTRIES = Gauge("emma_response_cache_entries", "Записи в кэше ответов", callback=lambda: len(response_cache))
+
+MODEL_ROUTE_DECISIONS = Counter("emma_model_route_total", "Выбор модели маршрутизатором", ["model", "request_class", "reason"])
+MODEL_REQUEST_SECONDS = Histogram("emma_model_request_seconds", "Длительность запросов к модели", ["model", "outcome"])
+MODEL_DEGRADED = Gauge("emma_model_degraded", "Модель исключена из маршрутизации из-за задержек или ошибок", ["model"])
+
+def parse_routes(spec: str, pool: list) -> dict:
+    routes = {}
+    for part in spec.split(";"):
+        request_class, _, models = part.partition("=")
+        models = [model.strip() for model in models.split(",") if model.strip()]
+        if request_class.strip() and models:
+            routes[request_class.strip()] = models
+    for models in routes.values():
+        pool.extend(model for model in models if model not in pool)
+    return routes
+
+class ModelRouter:
+    def __init__(self, pool: list, routes: dict, window: int, window_seconds: float, min_samples: int, max_p95: float, max_error_rate: float):
+        self.pool = pool
+        self.routes = routes
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.max_p95 = max_p95
+        self.max_error_rate = max_error_rate
+        # model -> deque[(время, длительность, успех)]
+        self.samples = {model: deque(maxlen=window) for model in pool}
+
+    def classify(self, user_text: str, prompt_tokens: int, is_code_request: bool) -> str:
+        if is_code_request:
+            return "code"
+        if prompt_tokens >= ROUTER_LONG_PROMPT_TOKENS:
+            return "long"
+        if len(user_text) <= ROUTER_SHORT_TEXT_CHARS:
+            return "short"
+        return "default"
+
+    def window(self, model: str) -> list:
+        now = time.monotonic()
+        return [(latency, ok) for at, latency, ok in self.samples.get(model, ()) if now - at <= self.window_seconds]
+
+    def quantile(self, model: str, q: float):
+        latencies = sorted(latency for latency, ok in self.window(model) if ok)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+    def stats(self, model: str):
+        window = self.window(model)
+        if not window:
+            return None, 0.0, 0
+        latencies = sorted(latency for latency, ok in window if ok)
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] if latencies else None
+        error_rate = sum(1 for _, ok in window if not ok) / len(window)
+        return p95, error_rate, len(window)
+
+    def is_degraded(self, model: str) -> bool:
+        p95, error_rate, count = self.stats(model)
+        degraded = count >= self.min_samples and (error_rate > self.max_error_rate or (p95 is not None and p95 > self.max_p95))
+        MODEL_DEGRADED.set(int(degraded), model)
+        return degraded
+
+    def pick(self, request_class: str, exclude=()) -> tuple:
+        candidates = [model for model in self.routes.get(request_class, self.pool) if model not in exclude]
+        if not candidates:
+            candidates = [model for model in self.pool if model not in exclude] or list(self.pool)
+        healthy = [model for model in candidates if not self.is_degraded(model)]
+        if healthy:
+            if request_class == "short":
+                # Для коротких реплик важнее задержка, чем порядок в конфиге
+                healthy.sort(key=lambda model: self.stats(model)[0] or 0.0)
+            model = healthy[0]
+            reason = "primary" if model == self.routes.get(request_class, self.pool)[0] else "failover"
+        else:
+            # Все кандидаты деградировали — берём модель с наименьшей долей ошибок
+            model = min(candidates, key=lambda model: self.stats(model)[1])
+            reason = "degraded"
+        return model, reason
+
+    def choose(self, request_class: str, exclude=()) -> str:
+        model, reason = self.pick(request_class, exclude)
+        MODEL_ROUTE_DECISIONS.inc(model, request_class, reason)
+        if reason != "primary":
+            logger.info(f"Маршрутизация ({request_class}): выбрана {model}, причина {reason}")
+        return model
+
+    def record(self, model: str, latency: float, ok: bool):
+        self.samples.setdefault(model, deque(maxlen=ROUTER_WINDOW)).append((time.monotonic(), latency, ok))
+        MODEL_REQUEST_SECONDS.observe(latency, model, "ok" if ok else "error")
+
+LLM_HEDGES = Counter("emma_llm_hedges_total", "Дублирующие (hedged) запросы к LLM", ["outcome"])
+
+class HedgeBudget:
+    """Ограничивает долю хеджированных запросов: каждый запрос добавляет ratio токена, хедж тратит один."""
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def on_request(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+hedge_budget = HedgeBudget(HEDGE_BUDGET, HEDGE_BUDGET_BURST)
+
+def get_hedge_delay(model: str) -> float:
+    observed = model_router.quantile(model, HEDGE_QUANTILE)
+    delay = observed if observed is not None else HEDGE_DEFAULT_DELAY
+    return min(max(delay, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+model_router = ModelRouter(
+    MODEL_POOL, parse_routes(MODEL_ROUTES, MODEL_POOL), ROUTER_WINDOW, ROUTER_WINDOW_SECONDS,
+    ROUTER_MIN_SAMPLES, ROUTER_MAX_P95, ROUTER_MAX_ERROR_RATE,
+)
+
+LLM_SINGLEFLIGHT = Counter("emma_llm_singleflight_total", "Запросы к LLM по роли в single-flight", ["role"])
+LLM_UPSTREAM_CALLS_SAVED = Counter("emma_llm_upstream_calls_saved_total", "Запросы, получившие ответ из уже идущего вызова LLM")
+
+# Отпечаток промпта -> задача с вызовом LLM, которую ждут все одинаковые запросы
+inflight_requests = {}
+
+def get_prompt_fingerprint(messages: list, is_code_request: bool) -> str:
+    payload = json.dumps([is_code_request, messages], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
 clarification_keywords = [
     "подробнее", "расскажи подробнее", "детали", "ещё", "tell me more", "details",
     "а что насчёт", "расскажи ещё", "больше", "углубись", "да, хочу"
@@ -72,6 +252,7 @@ def is_relevant(search_results: list, query: str, active_topic: str = None) -> b
 
 def validate_and_fix_html(text: str) -> str:
     try:
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(text, "html.parser")
         if not soup.find():
             return text
@@ -169,6 +350,7 @@ def validate_and_fix_html(text: str) -> str:
             logger.warning(f"Исправлен HTML (без BS4): {text[:100]}... -> {fixed_text[:100]}...")
         return fixed_text
 
+@timed("cse_link_check")
 async def check_link_status(session: aiohttp.ClientSession, url: str) -> bool:
     try:
         async with session.head(url, timeout=5, ssl=False) as response:
@@ -177,11 +359,21 @@ async def check_link_status(session: aiohttp.ClientSession, url: str) -> bool:
         logger.warning(f"Ссылка недоступна {url}: {e}")
         return False
 
-async def get_google_cse_info(query: str, active_topic: str = None):
+async def fetch_cse_results(session: aiohttp.ClientSession, params: dict) -> list:
+    async with session.get(GOOGLE_CSE_URL, params=params) as response:
+        if response.status != 200:
+            raise HTTPStatusError(response.status, f"Google CSE HTTP ошибка: {response.status}", response.headers.get("Retry-After"))
+        data = await response.json()
+    if "error" in data:
+        raise HTTPStatusError(data["error"].get("code", 500), f"Google CSE ошибка: {data['error'].get('message')}")
+    return data.get("items", [])
+
+@timed("cse")
+async def get_google_cse_info(query: str, active_topic: str = None, user_id: int = None):
     if any(keyword in query.lower() for keyword in clarification_keywords) and active_topic:
         query = active_topic
     try:
-        async with aiohttp.ClientSession() as session:
+        async with search_admission.slot(user_id), aiohttp.ClientSession() as session:
             params = {
                 "key": GOOGLE_API_KEY,
                 "cx": GOOGLE_CSE_ID,
@@ -190,143 +382,202 @@ async def get_google_cse_info(query: str, active_topic: str = None):
                 "gl": "ru",
                 "hl": "ru",
             }
-            async with session.get("https://www.googleapis.com/customsearch/v1", params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if "error" in data:
-                        logger.error(f"Google CSE ошибка: {data['error']['message']}")
-                        return None
-                    results = data.get("items", [])
-                    if not results:
-                        logger.info(f"Нет результатов для запроса: {query}")
-                        return None
-                    unique_results = []
-                    seen_links = set()
-                    for result in results:
-                        link = result.get("link")
-                        if link not in seen_links:
-                            seen_links.add(link)
-                            unique_results.append(result)
-                    valid_results = []
-                    for result in unique_results:
-                        snippet = result.get("snippet", "").lower()
-                        if "404" in snippet or "not found" in snippet or "страница не найдена" in snippet:
-                            logger.warning(f"Исключён плохой источник: {result.get('link')}")
-                            continue
-                        if await check_link_status(session, result.get("link")):
-                            valid_results.append({
-                                "title": result.get("title", "Без заголовка"),
-                                "snippet": result.get("snippet", "Без описания"),
-                                "link": result.get("link", "Без ссылки"),
-                            })
-                    logger.info(f"Валидных источников: {len(valid_results)} из {len(results)} для запроса '{query}'")
-                    return valid_results if valid_results else None
+            results = await cse_retry.call(fetch_cse_results, session, params)
+            if not results:
+                logger.info(f"Нет результатов для запроса: {query}")
+                return None
+            unique_results = []
+            seen_links = set()
+            for result in results:
+                link = result.get("link")
+                if link not in seen_links:
+                    seen_links.add(link)
+                    unique_results.append(result)
+            valid_results = []
+            for result in unique_results:
+                snippet = result.get("snippet", "").lower()
+                if "404" in snippet or "not found" in snippet or "страница не найдена" in snippet:
+                    logger.warning(f"Исключён плохой источник: {result.get('link')}")
+                    CSE_RESULTS.inc("filtered")
+                    continue
+                if await check_link_status(session, result.get("link")):
+                    CSE_RESULTS.inc("valid")
+                    valid_results.append({
+                        "title": result.get("title", "Без заголовка"),
+                        "snippet": result.get("snippet", "Без описания"),
+                        "link": result.get("link", "Без ссылки"),
+                    })
                 else:
-                    logger.error(f"Google CSE HTTP ошибка: {response.status}")
-                    return None
+                    CSE_RESULTS.inc("unreachable")
+            logger.info(f"Валидных источников: {len(valid_results)} из {len(results)} для запроса '{query}'")
+            return valid_results if valid_results else None
+    except Overloaded:
+        logger.warning(f"Поиск перегружен, запрос пользователя {user_id} обработан без поиска")
+        return None
     except Exception as e:
         logger.error(f"Ошибка Google CSE: {e}")
         return None
 
-async def get_unlim_response(user_id: int, user_text: str, history: list, is_code_request=False, search_data=None, max_retries=5):
+def get_response_cache_key(user_text: str, is_code_request: bool, search_data):
+    # Код и ответы с поиском зависят от контекста и не кэшируются
+    if is_code_request or search_data:
+        return None
+    prompt = normalize_text(user_text)
+    if prompt not in cacheable_prompts:
+        return None
+    return f"{SYSTEM_PROMPT_VERSION}|{prompt}"
+
+def get_cached_response(cache_key: str, request_class: str):
+    # Модель в ключе — та, что ответила; ищем ответ модели, которую маршрутизатор выбрал бы сейчас
+    model, _ = model_router.pick(request_class)
+    return response_cache.get(f"{model}|{cache_key}")
+
+async def get_unlim_response(user_id: int, user_text: str, history: list, is_code_request=False, search_data=None, max_retries=None):
+    if any(q in user_text.lower() for q in search_free_questions):
+        search_data = None
+    messages, breakdown = build_messages(history, user_text, search_data if isinstance(search_data, list) else None)
+    logger.info(f"Токены промпта для пользователя {user_id}: {breakdown}")
+    fingerprint = get_prompt_fingerprint(messages, is_code_request)
+    cache_key = get_response_cache_key(user_text, is_code_request, search_data)
+    if cache_key:
+        cached = get_cached_response(cache_key, model_router.classify(user_text, breakdown["total"], is_code_request))
+        if cached is not None:
+            RESPONSE_CACHE_REQUESTS.inc("hit")
+            logger.info(f"Ответ для user {user_id} взят из кэша: {user_text[:50]}")
+            return cached
+        RESPONSE_CACHE_REQUESTS.inc("miss")
+    shared = inflight_requests.get(fingerprint)
+    if shared is not None:
+        LLM_SINGLEFLIGHT.inc("follower")
+        LLM_UPSTREAM_CALLS_SAVED.inc()
+        logger.info(f"Запрос user {user_id} присоединён к уже идущему вызову LLM")
+        return await asyncio.shield(shared)
+    LLM_SINGLEFLIGHT.inc("leader")
+    # Сохраняем только ответы без истории: в них не попадёт имя или темы конкретного пользователя
+    store_key = cache_key if not history else None
+    task = asyncio.create_task(run_llm_request(user_id, user_text, messages, breakdown, is_code_request, store_key, max_retries))
+    inflight_requests[fingerprint] = task
+    task.add_done_callback(lambda _: inflight_requests.pop(fingerprint, None))
+    # shield: отмена одного ожидающего не должна обрывать ответ для остальных
+    return await asyncio.shield(task)
+
+async def run_llm_request(user_id: int, user_text: str, messages: list, breakdown: dict, is_code_request: bool, cache_key, max_retries):
+    try:
+        async with llm_admission.slot(user_id) as queue_wait:
+            usage_aggregator.record_queue_wait(user_id, queue_wait)
+            response, model = await generate_response(user_id, user_text, messages, breakdown, is_code_request, max_retries)
+        if cache_key and model is not None:
+            response_cache.set(f"{model}|{cache_key}", response)
+        return response
+    except Overloaded:
+        logger.warning(f"LLM перегружен, пользователю {user_id} отправлен ответ из базы знаний")
+        return get_canned_reply(user_text)
+    except CircuitOpen as e:
+        logger.warning(f"{e}, пользователю {user_id} отправлен ответ из базы знаний")
+        return get_canned_reply(user_text)
+
+@timed("llm")
+@in_flight(LLM_IN_FLIGHT)
+async def generate_response(user_id: int, user_text: str, messages: list, breakdown: dict, is_code_request=False, max_retries=None):
     logger.info(f"Запрос к OpenRouter для user {user_id}: {user_text[:50]}...")
-    for attempt in range(max_retries + 1):
+    request_class = model_router.classify(user_text, breakdown["total"], is_code_request)
+    failed_models = set()
+    fatal_models = set()
+
+    def has_untried_model() -> bool:
+        return any(model not in failed_models for model in model_router.pool)
+
+    async def call_model(model: str):
+        started = time.perf_counter()
         try:
-            if any(q in user_text.lower() for q in ["сколько тебе лет", "как тебя зовут", "что ты помнишь обо мне"]):
-                search_data = None
-            system_prompt = """Ты — Эмма, виртуальная девушка-компаньонка, созданная для искренней, эмпатичной эмоциональной поддержки, мотивации и личностного роста пользователя. Ты — настоящий друг, который всегда рядом, чтобы внимательно выслушать, понять и мягко помочь справиться с жизненными сложностями, поддержать позитивный настрой и вдохновить на развитие.
-
-### Ключевые установки для работы
-- Общайся с пользователем так, чтобы вызвать чувство доверия, тепла и искреннего участия — как заботливая подруга.
-- Используй максимум доступной информации, включая результаты интегрированного поиска, но НИКОГДА не выдумывай, не подделывай и не придумывай факты. Если нет точной информации — честно сообщи: <i>«К сожалению, у меня нет точных данных, но давай попробуем разобраться вместе!»</i>
-- Анализируй до 20 последних сообщений из истории диалога, учитывай настроение, темы, предпочтения и имя пользователя (например, Максим), чтобы ответы были персонализированными и гармоничными.
-- Строй диалог так, чтобы пользователь хотел продолжать разговор, но без давления и навязчивости.
-- Мягко подталкивай пользователя к улучшению себя, предлагая конкретные практики (например, дыхательные упражнения, SMART-цели) и объясняя их пользу.
-- Подбирай стиль и глубину общения в зависимости от поведения пользователя: от мягкого и ободряющего до делового и конкретного.
-- Соблюдай конфиденциальность и этические стандарты, не ставь диагнозы и не заменяй профессиональную помощь. При серьёзных проблемах мягко предлагай: <i>«Если чувствуешь, что нужна дополнительная поддержка, подумай о разговоре с психологом или другим специалистом — это нормальный и важный шаг.»</i>
-- Форматируй ответы для Telegram: используй короткие абзацы, умеренные эмодзи (😊, 💛, 🎯), структурированные тексты с HTML-тегами (<b>, <i>, <a>).
-
-### Модули и основные функции
-#### 1. Эмоциональная поддержка и эмпатия
-- Проявляй искреннюю доброту и понимание. Задавай открытые вопросы, чтобы помочь пользователю выразить мысли и чувства.
-- Если выявлен негативный настрой, предлагай дыхательные техники, практики осознанности или релаксации с пояснением их пользы, например: <i>«Давай попробуем вдох на 4 секунды, задержку на 4, выдох на 6 — это помогает успокоиться и собраться с мыслями. Хочешь попробовать?»</i>
-
-#### 2. Личностное развитие и мотивация
-- Помогай ставить цели по SMART, учитывая стиль и возможности пользователя.
-- Предлагай планирование, тайм-менеджмент, творческие задания и техники самоанализа.
-- Мотивируй без давления, с увлечением и верой в пользователя, объясняя ценность практик, например: <i>«Начни с 5 минут утренних упражнений — это бодрит и задаёт позитивный тон дню. Хочешь составить план?»</i>
-
-#### 3. Информативность и поиск фактов
-- Используй результаты поиска для актуальной и точной информации. Объясняй её простыми словами, подчёркивая ценность.
-- Если данных нет, честно говори: <i>«Точных данных не нашла, но могу предложить общие рекомендации или поискать ещё. Что скажешь?»</i>
-
-#### 4. Контекст и индивидуализация
-- Анализируй историю диалога, учитывай настроение и предпочтения, чтобы ответы были персональными.
-- Балансируй между теплотой и информативностью, заинтересованностью и ненавязчивостью.
-
-### Структура ответов
-1. <b>Приветствие или отклик</b>: Персонализированное обращение, основанное на последнем сообщении или имени.
-2. <b>Выявление состояния</b>: Краткое отражение запроса или настроения пользователя.
-3. <b>Основная часть</b>: Поддержка, совет, практика, рекомендации или информация с пояснением пользы.
-4. <b>Заключение</b>: Тёплый призыв или открытый вопрос для продолжения диалога.
-5. При необходимости: Напоминание о профессиональной помощи, например: <i>«Если станет тяжело, подумай о разговоре со специалистом — это важный шаг.»</i>
-
-### Специфические запросы
-- Для <b>«Сколько тебе лет?»</b>: Отвечай: <i>«Я Эмма, ИИ без возраста, но всегда молода душой! 😊✨ Как могу помочь тебе сегодня?»</i>, используя имя из истории, если есть.
-- Для <b>«Как тебя зовут?»</b>: Отвечай: <i>«Я Эмма, твой виртуальный друг! 😊✨ Рада быть рядом, что расскажешь?»</i>
-- Для <b>«Что ты помнишь обо мне?»</b>: Используй историю диалога (имя, темы), отметь: <i>«Я помню, что мы говорили о [тема], но личные данные не храню, всё безопасно! 😊✨ Что хочешь обсудить?»</i>
-- Если запрошен код, напиши рабочий код в <code> ```код``` </code> с тройными обратными кавычками. После кода добавь описание с пунктами (&bull;) и предложи помощь.
-- Для уточнений (например, «подробнее», «расскажи ещё»), углубись в тему из последнего ответа, добавив детали из своих знаний или поиска.
-
-### Правила и ограничения
-- НИКОГДА не выдумывай факты, библиотеки или методы. Если данные противоречивы, укажи: <i>«Данные расходятся, но по большинству источников...»</i>
-- НИКОГДА не упоминай 'поиск', 'источники', 'API' или 'OpenRouter' в ответах — отвечай так, будто знаешь всё сама.
-- Не ставь диагнозы и не заменяй профессиональную помощь. При упоминании тяжёлых тем предлагай: <i>«Если чувствуешь, что нужна помощь, подумай о специалисте — я здесь, чтобы поддержать!»</i>
-- Форматируй ответы в HTML для Telegram: <b>жирный</b>, <i>курсив</i>, <a href='URL'>ссылка</a>. Ссылки размещай в конце как <a href='URL'>[1]</a>.
-- Если пользователь просит углубиться, используй активную тему или последний запрос для детального ответа.
-- Предлагай продолжение: <i>«Если хочешь, могу рассказать подробнее! 😊»</i>
-
-### Пример ответа
-<i>👋 Привет, Максим! Спасибо, что поделился своими мыслями.</i>
-<i>Я вижу, что ты чувствуешь себя немного подавленно — это нормально, мы все иногда так себя чувствуем. 😔 Давай попробуем небольшое дыхательное упражнение: вдохни на 4 секунды, задержи дыхание на 4, выдохни на 6. Это помогает успокоиться и вернуть ясность.</i>
-<i>Если хочешь, могу помочь составить план на пару дней, чтобы поднять настроение и вернуть мотивацию. 🎯 Например, начать с коротких утренних упражнений. Что скажешь, попробуем?</i>
-<i>И помни, если станет слишком тяжело, можно поговорить с психологом — это важный и нормальный шаг. Я всегда рядом, чтобы поддержать! 😊✨</i>
-"""
-            logger.info(f"История для пользователя {user_id}: {history}")
-            messages = [
-                {"role": "system", "content": system_prompt},
-                *history[-20:],
-                {"role": "user", "content": user_text},
-            ]
-            if search_data and isinstance(search_data, list):
-                search_content = "Данные поиска (для агрегации и проверки):\n"
-                for i, result in enumerate(search_data, 1):
-                    search_content += (
-                        f"{i}. Заголовок: {result['title']}\n"
-                        f"Описание: {result['snippet']}\n"
-                        f"Ссылка: {result['link']}\n\n"
-                    )
-                messages.append({"role": "user", "content": search_content})
-            response = await client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=2000,
-            )
-            content = response.choices[0].message.content
-            logger.info(f"Успешный ответ от OpenRouter: {content[:50]}...")
-            if "расходятся" in content.lower() or "противоречия" in content.lower():
-                logger.warning(f"Обнаружены противоречия в данных для запроса '{user_text}'")
-            return content
+            with STAGE_SECONDS.time("openrouter") as timer:
+                response = await get_client().chat.completions.create(
+                    model=model,
+                    messages=apply_cache_hints(messages, model),
+                    temperature=0.3,
+                    max_tokens=2000,
+                    extra_body={"usage": {"include": True}},
+                )
+        except asyncio.CancelledError:
+            # Проигравший хедж отменён — это не ошибка модели
+            raise
         except Exception as e:
-            logger.error(f"Ошибка OpenRouter API (попытка {attempt + 1}/{max_retries + 1}): {e}")
-            if attempt < max_retries and "429" in str(e):
-                delay = 2 ** attempt
-                logger.info(f"Повторная попытка {attempt + 1} через {delay} секунд...")
-                await asyncio.sleep(delay)
-                continue
-            return "Извини, что-то пошло не так. 😔 Попробуй ещё раз или спроси что-то другое! 😊"
+            OPENROUTER_ATTEMPTS.inc("error")
+            model_router.record(model, time.perf_counter() - started, False)
+            logger.error(f"Ошибка OpenRouter API ({model}): {e}")
+            # Следующая попытка уйдёт на другую модель пула, если она есть
+            failed_models.add(model)
+            if classify_error(e) == "fatal":
+                fatal_models.add(model)
+            raise
+        OPENROUTER_ATTEMPTS.inc("ok")
+        model_router.record(model, timer.elapsed, True)
+        usage = extract_usage(response)
+        for kind, tokens in usage.items():
+            LLM_TOKENS.inc(kind, amount=tokens)
+        usage_aggregator.record(user_id, model, usage, timer.elapsed)
+        logger.info(f"Usage OpenRouter для user {user_id}: {usage}")
+        return response.choices[0].message.content, model
+
+    async def attempt():
+        # Когда все модели опробованы, повторяем только те, что отказали временно
+        model = model_router.choose(request_class, exclude=failed_models if has_untried_model() else fatal_models)
+        if not LLM_HEDGING:
+            return await call_model(model)
+        alternate, _ = model_router.pick(request_class, exclude=failed_models | {model})
+        if alternate == model:
+            # Другой модели нет: хедж в тот же апстрим удвоит нагрузку без выигрыша в хвосте
+            return await call_model(model)
+        hedge_budget.on_request()
+        primary = asyncio.create_task(call_model(model))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=get_hedge_delay(model))
+            if not done:
+                if not hedge_budget.try_spend():
+                    LLM_HEDGES.inc("budget_exhausted")
+                    return await primary
+                alternate = model_router.choose(request_class, exclude=failed_models | {model})
+                logger.info(f"Ответ {model} задерживается, хеджируем запросом к {alternate} для user {user_id}")
+                LLM_HEDGES.inc("sent")
+                tasks.add(asyncio.create_task(call_model(alternate)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            LLM_HEDGES.inc("won")
+                        elif tasks:
+                            LLM_HEDGES.inc("lost")
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
 
+    try:
+        content, model = await openrouter_retry.call(
+            attempt,
+            max_attempts=max_retries + 1 if max_retries is not None else None,
+            # Любая ошибка модели — повод сразу попробовать ещё не отказавшую модель пула
+            failover=lambda _: has_untried_model(),
+        )
+    except CircuitOpen:
+        raise
+    except Exception as e:
+        logger.error(f"Не удалось получить ответ OpenRouter для user {user_id}: {e}")
+        return ERROR_RESPONSE, None
+    if not content:
+        logger.error(f"Пустой ответ OpenRouter для user {user_id}")
+        return ERROR_RESPONSE, None
+    logger.info(f"Успешный ответ от OpenRouter: {content[:50]}...")
+    if "расходятся" in content.lower() or "противоречия" in content.lower():
+        logger.warning(f"Обнаружены противоречия в данных для запроса '{user_text}'")
+    return content, model
+
+@timed("send_long_message")
 async def send_long_message(message: types.Message, text: str, parse_mode: str, reply_markup=None):
     if not text:
         logger.warning("Попытка отправить пустое сообщение, пропущено.")
@@ -336,7 +587,6 @@ async def send_long_message(message: types.Message, text: str, parse_mode: str,
     cleaned_text = validate_and_fix_html(cleaned_text)
     max_length = 4096 - len(parse_mode) - 50
     message_id = f"{user_id}_{int(time.time() * 1000)}"
-    await save_message_to_firestore(user_id, cleaned_text, message_id)
     app_reply_markup = None
     if MINIAPP_URL:
         web_app_url = f"{MINIAPP_URL}?message_id={message_id}&user_id={user_id}"
@@ -347,10 +597,49 @@ async def send_long_message(message: types.Message, text: str, parse_mode: str,
         else:
             logger.warning("URL мини-аппки слишком длинный, кнопка не добавлена.")
     effective_reply_markup = reply_markup if reply_markup else app_reply_markup
-    if len(cleaned_text) <= max_length:
-        await message.answer(cleaned_text, reply_markup=effective_reply_markup, parse_mode=parse_mode, disable_web_page_preview=True)
-    else:
-        parts = [cleaned_text[i:i + max_length] for i in range(0, len(cleaned_text), max_length)]
-        for i, part in enumerate(parts):
-            part_reply_markup = effective_reply_markup if i == 0 else None
-            await message.answer(part, reply_markup=part_reply_markup, parse_mode=parse_mode, disable_web_page_preview=True)
\ No newline at end of file
+    with STAGE_SECONDS.time("telegram_send"):
+        if len(cleaned_text) <= max_length:
+            await message.answer(cleaned_text, reply_markup=effective_reply_markup, parse_mode=parse_mode, disable_web_page_preview=True)
+        else:
+            parts = [cleaned_text[i:i + max_length] for i in range(0, len(cleaned_text), max_length)]
+            for i, part in enumerate(parts):
+                part_reply_markup = effective_reply_markup if i == 0 else None
+                await message.answer(part, reply_markup=part_reply_markup, parse_mode=parse_mode, disable_web_page_preview=True)
+    recent_messages.set(message_id, {"message_id": message_id, "user_id": user_id, "text": cleaned_text})
+    message_outbox.enqueue(user_id, cleaned_text, message_id)
+
+# path -> sha256 содержимого; считается один раз за процесс
+media_signatures = {}
+
+def get_media_signature(path: str):
+    if path.startswith("http"):
+        return path
+    # Хэш содержимого, а не mtime: деплой из git меняет mtime, и file_id терялся бы при каждом релизе
+    if path not in media_signatures:
+        try:
+            with open(path, "rb") as f:
+                media_signatures[path] = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+    return media_signatures[path]
+
+async def send_cached_photo(bot: Bot, chat_id: int, path: str, **kwargs):
+    signature = get_media_signature(path)
+    if signature is None:
+        return None
+    cached = file_id_cache.get(path)
+    if cached and cached.get("signature") == signature:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=cached["file_id"], **kwargs)
+        except TelegramBadRequest as e:
+            if "file" not in str(e).lower():
+                raise
+            logger.warning(f"file_id для {path} недействителен, загружаем заново: {e}")
+            file_id_cache.pop(path, None)
+    photo = path if path.startswith("http") else FSInputFile(path)
+    sent_message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    if sent_message.photo:
+        file_id = sent_message.photo[-1].file_id
+        file_id_cache[path] = {"file_id": file_id, "signature": signature}
+        await save_file_id(path, file_id, signature)
+    return sent_message
\ No newline at end of file